@@ -0,0 +1,200 @@
+''' asyncio counterpart of the Model API.
+    Requires a client from redis.asyncio (redis-py 4.2 or newer). '''
+from functools import partial
+from itertools import islice
+from . import exceptions, proxies, utils
+from .fields import PrimaryKey
+
+
+class AsyncModel:
+    ''' Awaitable interface to `model` using the asyncio Redis client
+        `connection` (`model.async_redis` by default).
+
+        It relies on the fields, the scripts and the helpers of the model, and
+        returns ordinary instances of it. Foreign fields of those instances are
+        lazy (see proxies.foreignproxy). Models that define `async_redis`
+        get an instance of this class as `aio`, e.g.
+
+            instance = await Model.aio.new(...)
+            async for instance in Model.aio.get(...): ... '''
+
+    def __init__(self, model, connection=None):
+        if model.cluster_layout or model._shards is not None:
+            raise exceptions.UnsupportedOperation('The cluster layout and sharded'
+                                                  ' models are not supported by'
+                                                  ' the asyncio interface')
+        if connection is None:
+            connection = model.async_redis
+        self.model, self.redis = model, connection
+        self._scripts = {name: connection.register_script(utils.SCRIPTS[name])
+                         for name in model._scripts}
+
+    def __repr__(self):
+        return '<async interface to {!r} at {:#x}>'.format(self.model, id(self))
+
+    def get_pipeline(self, transaction=True):
+        return self.redis.pipeline(transaction=transaction)
+
+    async def count(self):
+        ''' Return the number of elements in 'model_name : _records' '''
+        return await self.redis.zcard(self.model.qualified('_records'))
+
+    async def new(self, **ka):
+        ''' Create and store a new instance of the model, see Model.new '''
+        model = self.model
+        pk, score, data, ka = model._new_prepare(ka)
+        script_ka, unique = model._new_arguments(pk, score, ka)
+        res = await self._scripts['new'](**script_ka)
+        model._check_new(res, unique, ka)
+        instance = model._build({}, data, lazy=True)
+        instance._invalidate()
+        return instance
+
+    async def get(self, pks=None, start=None, stop=None, offset=None,
+                  limit=None, chunk_size=None, with_fields=None, **ka):
+        ''' Asynchronous generator yielding instances of the model.
+            The arguments have the same meaning as for Model.get '''
+        model = self.model
+        z = any(x is not None for x in (start, stop, offset, limit))
+        if sum((z, pks is not None, len(ka) == 1)) != 1:
+            raise ValueError
+
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError('chunk_size must be positive')
+
+        if z:
+            if start is None:
+                start = '-inf'
+
+            if stop is None:
+                stop = '+inf'
+
+            key = model.qualified('_records')
+            pks = [model.deserialize(PrimaryKey, x) for x in
+                   await self.redis.zrangebyscore(key, start, stop, start=offset,
+                                                  num=limit)]
+
+        if pks is not None:
+            load, it = self._get_raw_by_pks, iter(pks)
+        else:
+            field, values = ka.popitem()
+            load, it = partial(self._get_raw_by_uniques, field), iter(values)
+
+        if chunk_size is None:
+            chunks = [list(it)]
+        else:
+            chunks = iter(lambda: list(islice(it, chunk_size)), [])
+
+        for chunk in chunks:
+            # Missing records are skipped, see Model.get
+            instances = [model._build({}, model._process_raw(r), lazy=True)
+                         for r in await load(chunk) if r]
+            if with_fields:
+                await self._load_auto(instances, with_fields)
+            for instance in instances:
+                yield instance
+
+    async def delete(self, instance):
+        ''' Completely delete `instance` from Redis '''
+        if not instance.good():
+            raise ValueError
+
+        keys, args = self.model._delete_arguments()
+        args.append(instance.primary_key)
+        await self._scripts['delete_many'](keys=keys, args=args)
+
+        instance._invalidate()
+        instance._field_cache.clear()
+        instance.data.clear()
+
+    async def update(self, instance, **values):
+        ''' Assign `values` to plain, unique and auto fields of `instance`,
+            as if they were assigned to its attributes '''
+        model, pk = self.model, instance.primary_key
+        unknown = values.keys() - model._plain.keys() - model._standalone_auto.keys()
+        if unknown:
+            raise AttributeError('Not plain, unique or auto fields: '
+                                 '{}'.format(', '.join(sorted(unknown))))
+
+        plain = {k: v for k, v in values.items() if k in model._plain}
+        save = plain
+        if plain.keys() & (model._unique_fields.keys() | model._indexed.keys()):
+            # Writes the record hash and updates the indexes as well
+            ka, unique = model._update_arguments(pk, plain, instance.data)
+            model._check_unique(await self._scripts['update'](**ka), unique)
+            save = {}
+
+        async with self.get_pipeline() as pipe:
+            if save:
+                save = {k: model.serialize(model._plain[k], v)
+                        for k, v in save.items()}
+                pipe.hset(model.qualified(pk=pk), mapping=save)
+            for name in values.keys() & model._standalone_auto.keys():
+                self._save_auto(pipe, model._standalone_auto[name],
+                                model.qualified(name, pk=pk), values[name])
+            await pipe.execute()
+
+        instance.data.update(plain)
+        for name in values.keys() & model._standalone_auto.keys():
+            field = model._standalone_auto[name]
+            if field.lazy:
+                # The view will be created on access
+                instance._field_cache.pop(name, None)
+            else:
+                # Changes to the proxy are written, as for sync instances
+                field._set_instance(instance, field._wrap(instance, values[name]))
+        instance._invalidate()
+
+    @staticmethod
+    def _save_auto(pipe, field, key, value):
+        # The same commands as in the 'new' script
+        pipe.delete(key)
+        args = field.flatten(value)
+        if args:
+            pipe.execute_command(field.command, key, *args)
+
+    async def load(self, instance, *fields):
+        ''' Fetch the values of auto fields `fields` (all auto fields that
+            aren't lazy if none are specified) and cache them in `instance` '''
+        await self._load_auto([instance], fields or self.model._eager_auto)
+
+    def proxy(self, instance, name):
+        ''' Return the command proxy for the standalone field `name` of `instance`.
+            Its methods return awaitables. '''
+        if name not in self.model._standalone:
+            raise AttributeError('{!r} is not a standalone field'.format(name))
+        key = self.model.qualified(name, pk=instance.primary_key)
+        # `self` has the `redis` attribute callproxy needs
+        return proxies.commandproxy(key, self)
+
+    async def _get_raw_by_pks(self, pks):
+        async with self.get_pipeline() as pipe:
+            for pk in pks:
+                self.model._get_raw_by_pk(pk, pipe)
+            return await pipe.execute()
+
+    async def _get_raw_by_uniques(self, field, values):
+        model = self.model
+        args = [model.qualified(pk='')]
+        args.extend(model.serialize(model._plain[field], x) for x in values)
+        res = await self._scripts['unique_get'](keys=[model._unique_keys[field]],
+                                                args=args)
+        return [dict(zip(r[::2], r[1::2])) for r in res]
+
+    async def _load_auto(self, instances, fields):
+        model = self.model
+        model._check_auto(fields)
+
+        wanted = [(ob, name) for ob in instances if ob.good() for name in fields]
+        if not wanted:
+            return
+
+        async with self.get_pipeline() as pipe:
+            for ob, name in wanted:
+                key = model.qualified(name, pk=ob.primary_key)
+                model._standalone_auto[name].request(key, pipe)
+            replies = await pipe.execute()
+
+        for (ob, name), reply in zip(wanted, replies):
+            field = model._standalone_auto[name]
+            field._set_instance(ob, field._wrap(ob, field.parse(reply, model.encoding)))
@@ -0,0 +1,274 @@
+import logging
+import redis
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger(__name__)
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses evictions expirations size maxsize')
+
+
+class RecordCache:
+    ''' Size-bounded LRU mapping with optional expiration of entries
+        `ttl` seconds after they were stored. Safe to use from
+        multiple threads.
+
+        The cache is bypassed while `active` is false. `version` changes on
+        every invalidation, pass its value from before the value was loaded
+        to `set` to avoid storing data invalidated in the meantime.
+
+        `on_first_use` is called (once) by the first `get`. '''
+
+    def __init__(self, maxsize, ttl=None, on_first_use=None):
+        if maxsize < 1:
+            raise ValueError('maxsize must be positive')
+        self.maxsize, self.ttl = maxsize, ttl
+        self.on_first_use = on_first_use
+        self.active = True
+        self.version = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key):
+        ''' Return the value stored for `key` or None '''
+        if self.on_first_use is not None:
+            with self._lock:
+                callback, self.on_first_use = self.on_first_use, None
+            if callback is not None:
+                callback()
+
+        with self._lock:
+            if not self.active:
+                self.misses += 1
+                return None
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, version=None):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            if not self.active:
+                return
+            if version is not None and version != self.version:
+                return
+            self._data[key] = value, expires
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self.version += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.version += 1
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             self.expirations, len(self._data), self.maxsize)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class Invalidator:
+    ''' Invalidates entries of registered caches when any client changes the
+        corresponding keys in Redis. Listens in a daemon thread on dedicated
+        connections, using either client-side tracking in broadcasting mode
+        ('tracking', Redis 6 or newer) or keyspace notifications
+        ('keyspace', notify-keyspace-events must include K and the classes of
+        commands used by the models, e.g. 'KA').
+
+        Registered caches are only active while the listener is subscribed,
+        and are cleared whenever it (re)subscribes. '''
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, connection, mode, retry_interval=1):
+        if mode not in {'tracking', 'keyspace'}:
+            raise ValueError('Unknown invalidation mode {!r}'.format(mode))
+        self.connection, self.mode = connection, mode
+        self.retry_interval = retry_interval
+        params = connection.connection_pool.connection_kwargs
+        self.encoding = params.get('encoding', 'utf-8')
+        self.db = params.get('db', 0)
+        # Prefix -> (cache, callback)
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def for_connection(cls, connection, mode):
+        ''' Return the invalidator shared by all users of the connection pool
+            of `connection` '''
+        key = connection.connection_pool, mode
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(connection, mode)
+            return cls._instances[key]
+
+    def register(self, prefix, cache, callback):
+        ''' Call `callback` with the rest of the key whenever a key starting
+            with `prefix` changes. `cache` stays inactive until the listener
+            is subscribed to those changes. '''
+        cache.active = False
+        with self._lock:
+            self._handlers[prefix] = cache, callback
+            self._changed.set()
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, daemon=True,
+                    name='fused-invalidator-{}'.format(self.mode))
+                self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._listen()
+            except redis.RedisError:
+                logger.warning('Cache invalidation listener failed, retrying in'
+                               ' %s seconds', self.retry_interval, exc_info=True)
+            # Nothing can be trusted while we aren't listening
+            with self._lock:
+                handlers = list(self._handlers.values())
+            for cache, _ in handlers:
+                cache.active = False
+                cache.clear()
+            self._changed.set()
+            self._stopped.wait(self.retry_interval)
+
+    def _make_connection(self):
+        ''' Create a dedicated connection that uses RESP2, so that
+            invalidations arrive as ordinary Pub/Sub messages '''
+        pool = self.connection.connection_pool
+        kwargs = pool.connection_kwargs.copy()
+        if 'protocol' in kwargs:
+            # redis-py 5 and newer may default to RESP3,
+            # and some of its features require it
+            kwargs['protocol'] = 2
+            for k in list(kwargs):
+                if k.startswith('maint_notifications'):
+                    del kwargs[k]
+        return pool.connection_class(**kwargs)
+
+    def _listen(self):
+        listener = self._make_connection()
+        tracker = self._make_connection() if self.mode == 'tracking' else None
+        try:
+            subscribed = set()
+            if tracker is not None:
+                listener.send_command('CLIENT', 'ID')
+                client_id = listener.read_response()
+                self._subscribe(listener, 'SUBSCRIBE', ['__redis__:invalidate'])
+
+            while not self._stopped.is_set():
+                if self._changed.is_set():
+                    self._changed.clear()
+                    with self._lock:
+                        new = [p for p in self._handlers if p not in subscribed]
+                    if new:
+                        if tracker is None:
+                            patterns = [self._pattern(p) for p in new]
+                            self._subscribe(listener, 'PSUBSCRIBE', patterns)
+                        else:
+                            args = ['CLIENT', 'TRACKING', 'on', 'REDIRECT',
+                                    client_id, 'BCAST']
+                            for p in new:
+                                args.extend(('PREFIX', p))
+                            tracker.send_command(*args)
+                            tracker.read_response()
+                        subscribed.update(new)
+                        self._activate(new)
+
+                if listener.can_read(timeout=0.1):
+                    self._handle(listener.read_response())
+        finally:
+            listener.disconnect()
+            if tracker is not None:
+                tracker.disconnect()
+
+    def _subscribe(self, listener, command, channels):
+        ''' Subscribe and wait for all confirmations '''
+        listener.send_command(command, *channels)
+        pending = len(channels)
+        while pending:
+            response = listener.read_response()
+            if self._decode(response[0]) == command.lower():
+                pending -= 1
+            else:
+                self._handle(response)
+
+    def _activate(self, prefixes):
+        with self._lock:
+            caches = [self._handlers[p][0] for p in prefixes]
+        for cache in caches:
+            cache.clear()
+            cache.active = True
+
+    def _pattern(self, prefix):
+        for c in '\\*?[]':
+            prefix = prefix.replace(c, '\\' + c)
+        return '__keyspace@{}__:{}*'.format(self.db, prefix)
+
+    def _decode(self, value):
+        if isinstance(value, bytes):
+            return value.decode(self.encoding, 'replace')
+        return value
+
+    def _handle(self, response):
+        kind = self._decode(response[0])
+        if kind == 'message':
+            keys = response[2]
+            if keys is None:
+                # The database was flushed
+                self._invalidate_all()
+                return
+            if not isinstance(keys, list):
+                keys = [keys]
+        elif kind == 'pmessage':
+            channel = self._decode(response[2])
+            keys = [channel.partition('__:')[2]]
+        else:
+            return
+
+        with self._lock:
+            handlers = list(self._handlers.items())
+        for key in keys:
+            key = self._decode(key)
+            for prefix, (cache, callback) in handlers:
+                if key.startswith(prefix):
+                    callback(key[len(prefix):])
+
+    def _invalidate_all(self):
+        with self._lock:
+            handlers = list(self._handlers.values())
+        for cache, _ in handlers:
+            cache.clear()
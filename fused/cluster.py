@@ -0,0 +1,143 @@
+''' Redis Cluster support, see Model.cluster_layout.
+
+    In the cluster layout the keys of a record (the hash and the standalone
+    keys) share the hash tag of the primary key, `Model:{pk}:field`, and the
+    keys shared by all records of a model (_records, unique indexes, other
+    indexes) share the hash tag of the model, `{Model}:_records`. Every
+    script call touches keys of one slot only. '''
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from .shard import ShardMap
+
+
+def is_cluster(connection):
+    ''' Return true if `connection` is a Redis Cluster client
+        (redis.cluster.RedisCluster, redis-py 4.1 or newer) '''
+    return hasattr(connection, 'get_node_from_key')
+
+
+def hash_tag(value):
+    ''' Return `value` enclosed in braces. Braces in `value` (and '%', the
+        escape character) are percent-encoded, so the whole value is the
+        hash tag '''
+    for c, escaped in (('%', '%25'), ('{', '%7B'), ('}', '%7D')):
+        value = value.replace(c, escaped)
+    return '{' + value + '}'
+
+
+def execute(connection, calls):
+    ''' Run `calls`, pairs of a key and a function issuing commands on the
+        pipeline it's passed (including script calls, which cluster
+        pipelines of redis-py refuse). A function may only use keys in the
+        hash slot of its key.
+
+        Calls are grouped by the node that serves their keys, and every node
+        gets one non-transactional pipeline, in parallel if there are
+        several. Return the list of replies of every call, in order.
+
+        If `connection` is a shard map (see fused.shard), calls are routed
+        by primary keys instead of keys. '''
+    if isinstance(connection, ShardMap):
+        groups = {}
+        for i, (pk, _) in enumerate(calls):
+            node = connection.get(pk)
+            groups.setdefault(id(node), (node, []))[1].append(i)
+    elif not is_cluster(connection):
+        groups = {None: (connection, list(range(len(calls))))}
+    else:
+        groups = {}
+        for i, (key, _) in enumerate(calls):
+            node = connection.get_node_from_key(key)
+            group = groups.setdefault(node.name, (
+                connection.get_redis_connection(node), []))
+            group[1].append(i)
+
+    replies = [None] * len(calls)
+
+    def run(group):
+        node, positions = group
+        bounds = []
+        with node.pipeline(transaction=False) as pipe:
+            for i in positions:
+                start = len(pipe)
+                calls[i][1](pipe)
+                bounds.append((i, start, len(pipe)))
+            res = pipe.execute()
+        for i, start, stop in bounds:
+            replies[i] = res[start:stop]
+
+    if len(groups) > 1:
+        with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+            list(executor.map(run, groups.values()))
+    else:
+        for group in groups.values():
+            run(group)
+
+    return replies
+
+
+def migrate(model, source, batch_size=500):
+    ''' Copy the records of `model` (which must use the cluster layout) and
+        its indexes from `source`, a connection to the Redis server that holds
+        them in the original layout, to the connection of `model`, `batch_size`
+        records at a time. Keys are copied with DUMP and RESTORE ... REPLACE,
+        so `source` must not decode responses. The source is left intact.
+
+        Return the number of copied records. '''
+    if not model.cluster_layout:
+        raise ValueError('{} does not use the cluster layout'.format(model.__name__))
+    if batch_size < 1:
+        raise ValueError('batch_size must be positive')
+
+    def old(*parts):
+        return model._field_sep.join((model.__name__,) + parts)
+
+    # Keys shared by all records
+    keys = [(old('_records'), model.qualified('_records'))]
+    keys.extend((old(name), key) for name, key in model._unique_keys.items())
+    for name, field in model._indexed.items():
+        if field.index == 'range':
+            keys.append((old('_range', name), model.qualified('_range', name)))
+            continue
+        prefix = old('_index', name, '').encode(model.encoding)
+        new = model.qualified('_index', name, '').encode(model.encoding)
+        for key in source.scan_iter(match=_escape(prefix) + b'*', count=batch_size):
+            keys.append((key, new + key[len(prefix):]))
+    _copy(model, source, keys)
+
+    copied, pk = 0, model._fields[model._primary_key]
+    it = (x for x, _ in source.zscan_iter(old('_records'), count=batch_size))
+    for batch in iter(lambda: list(islice(it, batch_size)), []):
+        keys = []
+        for x in batch:
+            x = model.deserialize(pk, x)
+            keys.append((old(x), model.qualified(pk=x)))
+            keys.extend((old(x, name), model.qualified(name, pk=x))
+                        for name in model._standalone)
+        _copy(model, source, keys)
+        copied += len(batch)
+
+    return copied
+
+
+def _escape(pattern):
+    ''' Escape glob-style special characters for SCAN ... MATCH '''
+    for c in b'\\*?[]':
+        pattern = pattern.replace(bytes([c]), b'\\' + bytes([c]))
+    return pattern
+
+
+def _copy(model, source, keys):
+    ''' Copy existing keys from `source` to the connection of `model`.
+        `keys` is a list of (source key, target key) pairs '''
+    with source.pipeline(transaction=False) as pipe:
+        for key, _ in keys:
+            pipe.dump(key)
+        dumps = pipe.execute()
+
+    calls = []
+    for (_, key), value in zip(keys, dumps):
+        if value is not None:
+            calls.append((key, lambda pipe, key=key, value=value: pipe.execute_command(
+                'RESTORE', key, 0, value, 'REPLACE')))
+    execute(model.__redis__, calls)
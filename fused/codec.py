@@ -0,0 +1,121 @@
+''' Codecs for values of plain (not standalone) container fields.
+
+    Encoded values start with the one-character marker of the codec that
+    produced them. Values without a known marker are Python literals written
+    by older versions of Fused, so existing data stays readable and gets
+    rewritten with the current codec on the next update. '''
+import abc
+import ast
+import base64
+import json
+
+# Marker -> codec
+_registry = {}
+
+
+def register(codec):
+    ''' Make values encoded by `codec` decodable '''
+    if len(codec.marker) != 1:
+        raise ValueError('Markers must be exactly one character long')
+    _registry[codec.marker] = codec
+    return codec
+
+
+def decode(data):
+    ''' Decode `data` (a string) with the codec it was encoded with '''
+    codec = _registry.get(data[:1])
+    if codec is None:
+        return ast.literal_eval(data)
+    return codec.loads(data[1:])
+
+
+class Codec(metaclass=abc.ABCMeta):
+
+    marker = None
+
+    @abc.abstractmethod
+    def dumps(self, value):
+        ''' Return a string representation of `value` '''
+
+    @abc.abstractmethod
+    def loads(self, data):
+        ''' Inverse of dumps '''
+
+    def encode(self, value):
+        return self.marker + self.dumps(value)
+
+
+class Literal(Codec):
+    ''' Python literals, the format used by older versions of Fused.
+        Values are written without a marker. '''
+
+    marker = ''
+
+    def dumps(self, value):
+        return str(value)
+
+    def loads(self, data):
+        return ast.literal_eval(data)
+
+
+# Keys of single-key JSON objects that represent non-JSON types
+_TAG = '\x00'
+_TUPLE, _SET, _FROZENSET, _BYTES, _DICT = (_TAG + x for x in 'tsfbd')
+
+
+def _pack(ob):
+    if ob is None or isinstance(ob, (str, int, float)):
+        return ob
+    if isinstance(ob, list):
+        return [_pack(x) for x in ob]
+    if isinstance(ob, dict):
+        if (all(isinstance(k, str) for k in ob) and
+                not (len(ob) == 1 and next(iter(ob)).startswith(_TAG))):
+            return {k: _pack(v) for k, v in ob.items()}
+        return {_DICT: [[_pack(k), _pack(v)] for k, v in ob.items()]}
+    if isinstance(ob, tuple):
+        return {_TUPLE: [_pack(x) for x in ob]}
+    if isinstance(ob, frozenset):
+        return {_FROZENSET: [_pack(x) for x in ob]}
+    if isinstance(ob, set):
+        return {_SET: [_pack(x) for x in ob]}
+    if isinstance(ob, bytes):
+        return {_BYTES: base64.b64encode(ob).decode('ascii')}
+    raise TypeError('Unable to encode {!r}'.format(ob))
+
+
+def _unpack(ob):
+    if len(ob) != 1:
+        return ob
+    tag, value = next(iter(ob.items()))
+    if tag == _TUPLE:
+        return tuple(value)
+    if tag == _SET:
+        return set(value)
+    if tag == _FROZENSET:
+        return frozenset(value)
+    if tag == _BYTES:
+        return base64.b64decode(value)
+    if tag == _DICT:
+        return {k: v for k, v in value}
+    return ob
+
+
+class JSON(Codec):
+    ''' Compact JSON. Tuples, sets, bytes and dictionaries with non-string
+        keys are stored as tagged objects and survive the round trip. '''
+
+    marker = 'J'
+
+    def dumps(self, value):
+        return json.dumps(_pack(value), separators=(',', ':'),
+                          ensure_ascii=False)
+
+    def loads(self, data):
+        return json.loads(data, object_hook=_unpack)
+
+
+register(JSON())
+
+# Used by container fields unless the field or its model specifies a codec
+default = _registry['J']
@@ -1,39 +1,61 @@
-from . import exceptions, utils, proxies
+from . import exceptions, utils, proxies, codec as codecs
 import abc
-import ast
 import redis
+from functools import partial
+from operator import methodcaller
 
 class Field(metaclass=abc.ABCMeta):
 
     def __init__(self, *, unique=False, standalone=False, auto=False,
-                          required=False):
+                          required=False, codec=None, index=False,
+                          lazy=False):
 
         if auto:
             standalone = True
 
+        if index not in {False, True, 'range'}:
+            raise ValueError('index must be a boolean or \'range\'')
+        if index and (unique or standalone):
+            raise ValueError('Only plain non-unique fields can be indexed')
+
         self.unique = unique
         self.required = required
         self.standalone = standalone
         self.auto = auto
+        # Encodes values of plain container fields, see fused.codec
+        self.codec = codec
+        # Maintain a set of primary keys for every value (see Model.filter),
+        # or a sorted set of primary keys scored by numeric values if 'range'
+        # (see Model.range)
+        self.index = index
+        # Auto containers: return read-only views that load the elements
+        # page by page (see proxies.listview etc.)
+        # Foreign fields: don't load the foreign instance until it's needed
+        self.lazy = lazy
 
     def __get__(self, model, model_type):
         if model is None:
             raise TypeError('Field.__get__ requires instance of '
                             '{!r}'.format(self.model_name))
-        if not model.good():
+        # Inlined model.good(), this is the hottest path for plain fields
+        data = model.data
+        if model._primary_key not in data:
             return None
 
         if not self.standalone:
-            return model.data.get(self.name)
+            return data.get(self.name)
 
         try:
-            return self._get_instance(model)
+            return model._field_cache[self.name]
         except KeyError as e:
             key = model.qualified(self.name, pk=model.primary_key)
             # TODO: Optimize auto fields by looking at model.data? No.
-            if self.auto:
+            if self.auto and self.lazy:
+                rv = self.view(key, model)
+            elif self.auto:
                 # Return an instance of the corresponding Python type
-                rv = self.fetch(key, model.__redis__, model.encoding)
+                rv = self.parse(model._fetch_auto(self), model.encoding)
+                rv = self._wrap(model, rv)
             else:
                 rv = proxies.commandproxy(key, model)
             self._set_instance(model, rv)
@@ -43,11 +65,17 @@ class Field(metaclass=abc.ABCMeta):
         if model is None:
             raise TypeError('Field.__set__ requires instance of '
                             '{!r}'.format(self.model_name))
-        if self.unique:
+        if self.standalone and not self.auto:
+            raise AttributeError("Can't assign to proxy fields")
+        if self.standalone and model._field_cache.get(self.name) is value:
+            # E.g. `model.field += ...`, the changes are already written
+            return
+        if not model.autosave:
+            # Written by model.save()
+            model._defer(self, value)
+        elif self.unique:
             model._update_unique({self.name: value})
         elif self.standalone:
-            if not self.auto:
-                raise AttributeError("Can't assign to proxy fields")
             key = model.qualified(self.name, pk=model.primary_key)
             # Containers can't be reliably updated using just one command
 
@@ -55,13 +83,18 @@ class Field(metaclass=abc.ABCMeta):
             if isinstance(model.redis, redis.client.Pipeline):
                 pipe = model.redis
             else:
-                pipe = model.get_pipeline()
+                pipe = model._pipeline()
 
             with pipe:
                 self.save(key, pipe, value)
                 pipe.execute()
 
-            self._set_instance(model, value) # TODO copy?
+            model._invalidate()
+            if self.lazy:
+                # The view will be created on access
+                model._field_cache.pop(self.name, None)
+            else:
+                self._set_instance(model, self._wrap(model, value))
         else:
             model._update_plain({self.name: value})
 
@@ -69,6 +102,7 @@ class Field(metaclass=abc.ABCMeta):
         if model is None:
             raise TypeError('Field.__delete__ requires instance of '
                             '{!r}'.format(self.model_name))
+        model._changes.pop(self.name, None)
         if self.unique:
             model._delete_unique([self.name])
             model.data.pop(self.name, None)
@@ -82,6 +116,25 @@ class Field(metaclass=abc.ABCMeta):
             # TODO: Handle auto fields. The fuck you mean, past me?
             # TODO: replace with a default to avoid another DB request?
             model._field_cache.pop(self.name, None)
+            model._invalidate()
+
+    def converter(self, encoding, binary):
+        ''' Return a function converting raw values of this field coming from
+            a HASH to Python objects. `binary` is true if the values are bytes
+            and false if they were decoded by redis-py (decode_responses) '''
+        return partial(self.deserialize, encoding=encoding)
+
+    # Auto fields are fetched in two steps, `request` issues the command
+    # (possibly on a pipeline) and `parse` converts the reply
+
+    @classmethod
+    def fetch(cls, key, connection, encoding):
+        # Fetches the data immediately
+        return cls.parse(cls.request(key, connection), encoding)
+
+    def _wrap(self, model, value):
+        ''' Return the object auto fields of `model` hold for `value` '''
+        return value
 
     def _set_instance(self, model, new):
         model._field_cache[self.name] = new
@@ -92,6 +145,13 @@ class Field(metaclass=abc.ABCMeta):
 
 class String(Field):
 
+    # Command (and its arguments) that stores the value in a standalone key
+    command = 'SET'
+
+    @staticmethod
+    def flatten(value):
+        return [value]
+
     @staticmethod
     def serialize(value, encoding=None):
         if encoding is not None:
@@ -106,10 +166,16 @@ class String(Field):
         else:
             return value
 
+    def converter(self, encoding, binary):
+        return methodcaller('decode', encoding) if binary else str
+
     @staticmethod
-    def fetch(key, connection, encoding):
-        # Fetches the data immediately
-        return String.deserialize(connection.get(key) or '', encoding)
+    def request(key, connection):
+        return connection.get(key)
+
+    @staticmethod
+    def parse(res, encoding):
+        return String.deserialize(res or '', encoding)
 
     @staticmethod
     def save(key, connection, value):
@@ -118,46 +184,66 @@ class String(Field):
 
 class List(Field):
 
-    serialize = staticmethod(String.serialize)
+    def serialize(self, value, encoding=None, codec=None):
+        codec = codec or self.codec or codecs.default
+        return String.serialize(codec.encode(value), encoding)
+    command = 'RPUSH'
+    flatten = staticmethod(list)
 
     @staticmethod
     def deserialize(value, encoding=None):
-        return ast.literal_eval(String.deserialize(value, encoding))
+        return codecs.decode(String.deserialize(value, encoding))
 
     @staticmethod
-    def fetch(key, connection, encoding):
-        # Fetches the data immediately
-        res = connection.lrange(key, 0, -1)
-        return [String.deserialize(x, encoding) for x in res]
+    def request(key, connection):
+        return connection.lrange(key, 0, -1)
 
     @staticmethod
-    def save(key, connection, value):
+    def parse(res, encoding):
+        return [String.deserialize(x, encoding) for x in res]
+
+    def save(self, key, connection, value):
+        # The same commands as in the 'new' script, empty containers
+        # are just deleted
         connection.delete(key)
-        connection.rpush(key, *value)
+        args = self.flatten(value)
+        if args:
+            connection.execute_command(self.command, key, *args)
+
+    def _wrap(self, model, value):
+        return proxies.listproxy(model, self, value)
+
+    view = proxies.listview
 
 
 class Set(Field):
 
-    serialize = staticmethod(String.serialize)
+    serialize = List.serialize
+    deserialize = staticmethod(List.deserialize)
+    command = 'SADD'
+    flatten = staticmethod(list)
 
     @staticmethod
-    def deserialize(value, encoding=None):
-        return ast.literal_eval(String.deserialize(value, encoding))
+    def request(key, connection):
+        return connection.smembers(key)
 
     @staticmethod
-    def fetch(key, connection, encoding): 
-        # Fetches the data immediately
-        res = connection.smembers(key)
+    def parse(res, encoding):
         return {String.deserialize(x, encoding) for x in res}
 
-    @staticmethod
-    def save(key, connection, value):
-        connection.delete(key)
-        connection.sadd(key, *value)
+    save = List.save
+
+    def _wrap(self, model, value):
+        return proxies.setproxy(model, self, value)
+
+    view = proxies.setview
 
 
 class Bytes(Field):
 
+    command = 'SET'
+    flatten = staticmethod(String.flatten)
+
     @staticmethod
     def serialize(value, encoding=None):
         # Return the value unchanged
@@ -168,9 +254,11 @@ class Bytes(Field):
         # Return the value unchanged
         return value
 
+    request = staticmethod(String.request)
+
     @staticmethod
-    def fetch(key, connection, encoding):
-        return connection.get(key) or b''
+    def parse(res, encoding):
+        return res or b''
 
     @staticmethod
     def save(key, connection, value):
@@ -181,59 +269,80 @@ class Bytes(Field):
 class Integer(Field):
 
     serialize = staticmethod(String.serialize)
+    command = 'SET'
+    flatten = staticmethod(String.flatten)
 
     @staticmethod
     def deserialize(value, encoding=None):
         return int(value)
 
+    def converter(self, encoding, binary):
+        return int
+
+    request = staticmethod(String.request)
+
     @staticmethod
-    def fetch(key, connection, encoding):
-        return Integer.deserialize(connection.get(key) or 0)
+    def parse(res, encoding):
+        return Integer.deserialize(res or 0)
 
     save = staticmethod(String.save)
 
 
 class Hash(Field):
 
-    serialize = staticmethod(String.serialize)
+    serialize = List.serialize
+    deserialize = staticmethod(List.deserialize)
+    command = 'HMSET'
 
     @staticmethod
-    def deserialize(value, encoding=None):
-        return ast.literal_eval(String.deserialize(value, encoding))
+    def flatten(value):
+        if not isinstance(value, dict):
+            value = dict(value)
+        return [x for pair in value.items() for x in pair]
+
+    @staticmethod
+    def request(key, connection):
+        return connection.hgetall(key)
 
     @staticmethod
-    def fetch(key, connection, encoding):
-        res = connection.hgetall(key)
+    def parse(res, encoding):
         dm = lambda x: String.deserialize(x, encoding)
         return {dm(k): dm(v) for k, v in res.items()}
 
-    @staticmethod
-    def save(key, connection, value):
-        if not isinstance(value, dict):
-            value = dict(value)
-        connection.delete(key)
-        connection.hmset(key, value)
+    save = List.save
+
+    def _wrap(self, model, value):
+        return proxies.hashproxy(model, self, value)
+
+    view = proxies.hashview
 
 
 class SortedSet(Field):
 
-    serialize = staticmethod(String.deserialize)
+    serialize = List.serialize
+    deserialize = staticmethod(List.deserialize)
+    command = 'ZADD'
 
     @staticmethod
-    def deserialize(value, encoding=None):
-        return ast.literal_eval(String.deserialize(value, encoding))
+    def flatten(value):
+        if not isinstance(value, dict):
+            value = dict(value)
+        return [x for k, v in value.items() for x in (v, k)]
 
     @staticmethod
-    def fetch(key, connection, encoding):
-        res = connection.zrange(key, start=0, end=-1, withscores=True)
-        return {String.deserialize(k, encoding): v for k, v in res}
+    def request(key, connection):
+        return connection.zrange(key, start=0, end=-1, withscores=True)
 
     @staticmethod
-    def save(key, connection, value):
-        if not isinstance(value, dict):
-            value = dict(value)
-        connection.delete(key)
-        connection.zadd(key, **value)
+    def parse(res, encoding):
+        return {String.deserialize(k, encoding): v for k, v in res}
+
+    save = List.save
+
+    def _wrap(self, model, value):
+        return proxies.sortedsetproxy(model, self, value)
+
+    view = proxies.sortedsetview
 
 
 # TODO: Add Integer (AI) field?
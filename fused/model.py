@@ -1,15 +1,63 @@
 import redis
-import json
+import base64
+import heapq
+import math
 import time
+from concurrent.futures import ThreadPoolExecutor
 from abc import ABCMeta
 from collections.abc import Mapping
-from itertools import chain
-from . import utils, exceptions
+from functools import partial
+from itertools import chain, islice, takewhile
+from operator import itemgetter
+from . import utils, exceptions, proxies, cluster, replica
+from .cache import RecordCache, Invalidator
+from .shard import ShardMap
 # All subclasses of Field and Field itself
 from .fields import *
 
 # Store instances of classes created by MetaModel
 _registry = {}
+# Previous value of a field that wasn't set
+_missing = object()
+
+
+class Row(tuple):
+    ''' Immutable, compact read-only view of a record. Subclasses with
+        properties for every plain field are generated for each model. '''
+
+    __slots__ = ()
+    _model = None
+    _fields = ()
+
+    @classmethod
+    def _from_data(cls, data):
+        return tuple.__new__(cls, map(data.get, cls._fields))
+
+    @property
+    def primary_key(self):
+        return getattr(self, self._model._primary_key)
+
+    def as_dict(self):
+        ''' Return the values of present fields as a dictionary '''
+        return {k: v for k, v in zip(self._fields, self) if v is not None}
+
+    def instance(self):
+        ''' Convert to a full instance of the model (without reloading it) '''
+        return self._model(data=self.as_dict())
+
+    def __repr__(self):
+        return '<{}Row/{}={!r}>'.format(self._model.__name__,
+                                        self._model._primary_key,
+                                        self.primary_key)
+
+
+def _row_type(model):
+    ''' Create a subclass of Row for `model` '''
+    names = tuple(model._plain)
+    attrs = {'__slots__': (), '_model': model, '_fields': names}
+    for i, name in enumerate(names):
+        attrs[name] = property(itemgetter(i))
+    return type(model.__name__ + 'Row', (Row,), attrs)
 
 
 def _rec_bases(o):
@@ -23,15 +71,24 @@ class MetaModel(ABCMeta):
     def __new__(mcs, model_name, bases, attrs):
         mappings = ('_fields', '_unique_keys', '_unique_fields',
                     '_required_fields', '_plain_fields', '_standalone_proxy',
-                    '_standalone_auto', '_scripts', '_foreign')
+                    '_standalone_auto', '_scripts', '_foreign', '_indexed')
         for m in mappings:
             attrs[m] = {}
 
         cls = super().__new__(mcs, model_name, bases, attrs)
 
         cls._pk = None
+        # The shard map if the model is sharded (see fused.shard)
+        cls._shards = None
+        cls._replicas = None
         _registry[cls.__name__] = cls
 
+        # Every model gets its own cache
+        if cls.cache_size:
+            cls._cache = RecordCache(cls.cache_size, cls.cache_ttl)
+        else:
+            cls._cache = None
+
         try:
             cls.__redis__ = cls.redis
         except AttributeError:
@@ -40,9 +97,31 @@ class MetaModel(ABCMeta):
         else:
             # Get some information from the connection instance
             # We need to know the encoding to deserialize some fields
-            params = cls.redis.connection_pool.connection_kwargs
-            dr = params.get('decode_responses', False)
-            cls.encoding = params.get('encoding', 'utf-8')
+            connection = cls.redis
+            if isinstance(connection, ShardMap):
+                cls._shards = connection
+                connection = connection.connections()[0]
+                if cls.cluster_layout or cls.cache_invalidation:
+                    raise exceptions.UnsupportedOperation(
+                        '{} is sharded, cluster_layout and cache_invalidation'
+                        ' are not supported'.format(model_name))
+            if cluster.is_cluster(connection):
+                if not cls.cluster_layout:
+                    raise exceptions.FusedError('{} must set cluster_layout = True to use'
+                                                ' Redis Cluster'.format(model_name))
+                encoder = connection.get_encoder()
+                dr, cls.encoding = encoder.decode_responses, encoder.encoding
+            else:
+                params = connection.connection_pool.connection_kwargs
+                dr = params.get('decode_responses', False)
+                cls.encoding = params.get('encoding', 'utf-8')
+
+        if cls.redis_read:
+            if cls.cluster_layout or cls._shards is not None:
+                raise exceptions.UnsupportedOperation(
+                    'Read replicas are not supported in the cluster layout'
+                    ' or for sharded models')
+            cls._replicas = replica.ReplicaSet(cls.redis_read, cls.read_balancing)
 
         # Allow the use of common fields defined in base models
         for name, field in dict(_rec_bases(cls)).items():
@@ -59,6 +138,10 @@ class MetaModel(ABCMeta):
                 cls._foreign[name] = field
 
             if field.unique:
+                if cls._shards is not None:
+                    raise exceptions.UnsupportedOperation(
+                        'Sharded models can\'t have unique fields, {!r} is '
+                        'unique'.format(name))
                 cls._unique_fields[name] = field
                 cls._unique_keys[name] = cls.qualified(name)
             elif field.standalone:
@@ -69,19 +152,71 @@ class MetaModel(ABCMeta):
             else:
                 cls._plain_fields[name] = field
 
+            if field.index:
+                cls._indexed[name] = field
+
+            if field.auto and field.lazy and not hasattr(field, 'view'):
+                raise exceptions.FusedError('Only auto container fields can be'
+                                            ' lazy, {!r} is not'.format(name))
+
             if field.required:
                 cls._required_fields[name] = field
 
         cls._standalone = dict(cls._standalone_proxy, **cls._standalone_auto)
+        # Auto fields loaded by `load` by default, lazy ones are read on access
+        cls._eager_auto = [k for k, v in cls._standalone_auto.items() if not v.lazy]
         cls._plain = dict(cls._unique_fields, **cls._plain_fields)
 
+        cls._row = _row_type(cls)
+
+        # Plain container fields without a codec of their own use the codec
+        # of the model. Fields are shared with subclasses, so it's kept here
+        cls._codecs = {}
+        if cls.codec is not None:
+            for field in cls._plain.values():
+                if field.codec is None and isinstance(field, (List, Set, Hash, SortedSet)):
+                    cls._codecs[field] = cls.codec
+
+        # Raw HASH keys (bytes, or strings if decode_responses is enabled)
+        # -> (name, converter) for _process_raw
+        cls._decoders = {}
+        for name, field in cls._plain.items():
+            cls._decoders[name] = name, field.converter(cls.encoding, False)
+            cls._decoders[name.encode(cls.encoding)] = (
+                name, field.converter(cls.encoding, True))
+
         # We can register those now and change the connection later
-        scripts = ['primary_key']
+        scripts = ['new', 'page', 'delete_many']
+        if cls._unique_fields or cls._indexed:
+            scripts.append('update')
         if cls._unique_fields:
-            scripts.append('unique')
+            scripts.append('unique_get')
+        if cls._indexed:
+            scripts.append('filter')
+        if cls.cluster_layout:
+            scripts.extend(('reindex', 'record'))
 
+        # Scripts of sharded models are always called with a connection
         for s in scripts:
-            cls._scripts[s] = cls.__redis__.register_script(utils.SCRIPTS[s])
+            cls._scripts[s] = connection.register_script(utils.SCRIPTS[s])
+
+        if hasattr(cls, 'async_redis'):
+            # Requires Python 3.6
+            from .aio import AsyncModel
+            cls.aio = AsyncModel(cls)
+
+        if cls._cache is not None and cls.cache_invalidation:
+            if cls.cluster_layout:
+                raise exceptions.UnsupportedOperation(
+                    'cache_invalidation is not supported in the cluster layout')
+            invalidator = Invalidator.for_connection(cls.__redis__,
+                                                     cls.cache_invalidation)
+            # The listener starts when the cache is first used, the cache
+            # stays inactive until then
+            cls._cache.active = False
+            cls._cache.on_first_use = partial(
+                invalidator.register, cls.qualified(pk=''), cls._cache,
+                cls._invalidate_key)
 
         return cls
 
@@ -89,11 +224,29 @@ class MetaModel(ABCMeta):
 class Model(metaclass=MetaModel):
 
     _field_sep = ':'
-
-    def __init__(self, *, data=None, **ka):
-        self._field_cache = {}
-        self.__context_depth__ = 0
-        self.data = {}
+    # Set `cache_size` to cache up to that many records in memory,
+    # `cache_ttl` is the maximum age of cached records in seconds
+    cache_size = None
+    cache_ttl = None
+    # Set to 'tracking' or 'keyspace' to invalidate cached data when other
+    # clients change it (see cache.Invalidator)
+    cache_invalidation = None
+    # Default codec for plain container fields, see fused.codec
+    codec = None
+    # If false, assignments to plain, unique and auto fields only change
+    # the instance until `save` is called
+    autosave = True
+    # Use hash tags in key names so that the keys of every record, and the
+    # keys shared by all records, are in one hash slot (see fused.cluster).
+    # Required for Redis Cluster
+    cluster_layout = False
+    # Connections to read replicas of `redis` for read-only requests and the
+    # way to choose between them, 'round-robin' or 'latency' (see fused.replica)
+    redis_read = None
+    read_balancing = 'round-robin'
+
+    def __init__(self, *, data=None, consistent=False, **ka):
+        self._setup()
         # If the PK is present, we assume that the rest of fields
         # are there as well
         if data is None or self._primary_key not in data and not 'primary_key' in data:
@@ -102,56 +255,155 @@ class Model(metaclass=MetaModel):
             # Will only search by one pair
             field, value = ka.popitem()
             if field in {self._primary_key, 'primary_key'}:
-                raw = self._get_raw_by_pk(value)
+                raw = self._get_raw_by_pks([value], consistent)[0]
             elif field not in self._unique_fields:  
                 raise TypeError('Attempted to get by non-unique'
                                 ' field {!r}'.format(field))
             else:
-                raw = self._get_raw_by_unique(field, value)
+                raw = self._get_raw_by_unique(field, value, consistent)
 
             self.data.update(self._process_raw(raw))
 
         self._prepare(data or {})
 
+    def _setup(self):
+        ''' Initialize the per-instance state '''
+        self._field_cache = {}
+        self.__context_depth__ = 0
+        self.data = {}
+        # Field name -> value before the first unsaved assignment
+        self._changes = {}
+
+    @classmethod
+    def _build(cls, loaded, data, prefetched=None, lazy=False):
+        ''' Create an instance without any requests. `loaded` is the processed
+            data of the record, the rest is passed to _prepare '''
+        ob = cls.__new__(cls)
+        ob._setup()
+        ob.data.update(loaded)
+        ob._prepare(data, prefetched, lazy)
+        return ob
+
     @classmethod
     def _get_raw_pk_by_unique(cls, field, value, connection=None):
         ''' Retrieve the primary key by one of the unique fields
             Exactly one action to make it usable with pipes. '''
         # TIL: Pipelines may be False in boolean context.
-        conn = connection if connection is not None else cls.__redis__
-        return conn.hget(cls.qualified(field), value)
+        conn = connection if connection is not None else cls._reader()
+        return conn.hget(cls.qualified(field), cls.serialize(cls._plain[field], value))
+
+    @classmethod
+    def _connection(cls, pk):
+        ''' Return the connection to the server that holds the record `pk` '''
+        if cls._shards is not None:
+            return cls._shards.get(pk)
+        return cls.__redis__
+
+    @classmethod
+    def _reader(cls, pk=None, consistent=False):
+        ''' Return the connection for read-only requests (for the record `pk`
+            if specified): one of the read replicas unless `consistent` is
+            true or reads are consistent in this context (see replica.consistent).
+            The primary is used if no replica is reachable '''
+        if cls._replicas is not None and not consistent and not replica.is_consistent():
+            conn = cls._replicas.get()
+            if conn is not None:
+                return conn
+        return cls.__redis__ if pk is None else cls._connection(pk)
 
     @classmethod
     def _get_raw_by_pk(cls, pk, connection=None):
         ''' Retrieve the HASH stored at cls.qualified(pk=pk).
             Exactly one action to make it usable with pipes. '''
+        pk = cls.deserialize(PrimaryKey, pk)
         # Pipelines may be False in boolean context.
-        conn = connection if connection is not None else cls.__redis__
-        key = cls.qualified(pk=cls.deserialize(PrimaryKey, pk))
+        conn = connection if connection is not None else cls._connection(pk)
+        key = cls.qualified(pk=pk)
         return conn.hgetall(key)
 
     @classmethod
-    def _get_raw_by_unique(cls, field, value):
-        ''' Get the primary key by one of the unique fields and return the 
-            result of passing it to _get_raw_by_pk '''
-        pk = cls._get_raw_pk_by_unique(field, value)
-        return cls._get_raw_by_pk(cls.deserialize(PrimaryKey, pk))
+    def _get_raw_by_pks(cls, pks, consistent=False):
+        ''' Retrieve the HASHes for all primary keys from `pks`. Records
+            that aren't cached are loaded in one pipeline. Only records
+            read from the primary are cached, replicas may lag behind. '''
+        pks = [cls.deserialize(PrimaryKey, x) for x in pks]
+        if cls._cache is None:
+            raw = [None] * len(pks)
+        else:
+            version = cls._cache.version
+            raw = [cls._cache.get(x) for x in pks]
+
+        missing = [i for i, r in enumerate(raw) if r is None]
+        conn = cls._reader(consistent=consistent)
+        cache = cls._cache if conn is cls.__redis__ else None
+        if len(missing) == 1:
+            # No need for a pipeline
+            pk = pks[missing[0]]
+            # Sharded models have no replicas, `conn` is the shard map
+            res = [cls._get_raw_by_pk(pk, conn if cls._shards is None else None)]
+        elif missing and cls._shards is not None:
+            # One pipeline per shard, in parallel
+            calls = [(pks[i], partial(cls._get_raw_by_pk, pks[i])) for i in missing]
+            res = [r for r, in cluster.execute(cls.__redis__, calls)]
+        elif missing:
+            with conn.pipeline(transaction=not cls.cluster_layout) as pipe:
+                for i in missing:
+                    cls._get_raw_by_pk(pks[i], pipe)
+                res = pipe.execute()
+
+        for i, r in zip(missing, res if missing else ()):
+            raw[i] = r
+            # Don't cache missing records
+            if r and cache is not None:
+                cache.set(pks[i], r, version)
+
+        return raw
+
+    @classmethod
+    def _get_raw_by_unique(cls, field, value, consistent=False):
+        ''' Get the HASH of the record by one of the unique fields.
+            Takes exactly one script call. '''
+        return cls._get_raw_by_uniques(field, [value], consistent)[0]
+
+    @classmethod
+    def _get_raw_by_uniques(cls, field, values, consistent=False):
+        ''' Resolve `values` of the unique field to primary keys and retrieve
+            the HASHes stored at those keys in one script call. Return a list
+            of mappings, empty ones for missing records. '''
+        # Index entries are serialized like values in the record hash
+        values = [cls.serialize(cls._plain[field], x) for x in values]
+        if cls.cluster_layout:
+            # The index and the records are in different slots
+            if not values:
+                return []
+            pks = cls.__redis__.hmget(cls._unique_keys[field], values)
+            found = iter(cls._get_raw_by_pks([x for x in pks if x is not None]))
+            return [{} if x is None else next(found) for x in pks]
+
+        args = [cls.qualified(pk='')]
+        args.extend(values)
+        res = cls._scripts['unique_get'](keys=[cls._unique_keys[field]], args=args,
+                                         client=cls._reader(consistent=consistent))
+        return [dict(zip(r[::2], r[1::2])) for r in res]
 
     @classmethod
     def _process_raw(cls, raw):
         ''' Iterate over raw mapping received t to _get_raw_by_pk, convert
             each value using appropriate deserialize conversion, and
             return the result '''
+        decoders = cls._decoders
         rv = {}
         for key, value in raw.items():
-            decoded = cls.deserialize(String, key)
-            ob = cls._plain[decoded]
-            rv[decoded] = cls.deserialize(ob, value)
+            name, convert = decoders[key]
+            rv[name] = convert(value)
         return rv
 
-    def _prepare(self, data):
+    def _prepare(self, data, prefetched=None, lazy=False):
         ''' Initialize all 'foreign' fields (create instances of corresponding
-            classes) and update `self.data` '''
+            classes) and update `self.data`. Foreign records found in
+            `prefetched` (see _prefetch) are used without any requests.
+            Lazy foreign fields (all of them if `lazy` is true) get
+            placeholders that are loaded on first access. '''
 
         # Everything we fetch from Redis goes to `self.data`
         # `data` is the dictionary passed from the __init__
@@ -159,15 +411,16 @@ class Model(metaclass=MetaModel):
         original = self.data.copy()
         self.data.update(data)
 
+        if self._shards is not None and self.good():
+            # All requests of the instance go to its shard
+            self.redis = self.__redis__ = self._shards.get(self.primary_key)
+
         for field, ob in self._foreign.items():
             if field not in data and field not in original:
                 continue
 
             # May either be a string or a type, but `ft` will always be a type
-            if isinstance(ob.foreign, type):
-                ft = ob.foreign
-            else:
-                ft = _registry[ob.foreign]
+            ft = self._foreign_model(field)
 
             if field in data:
                 fv = data[field]
@@ -184,70 +437,486 @@ class Model(metaclass=MetaModel):
                 ff = ft.get_foreign(type(self))
                 # Insert `self` in the `data` dictionary of the foreign object, then
                 # put the object in `self.data`
-                self.data[field] = ft(data=dict.fromkeys(ff, self), primary_key=fv)
+                backrefs = dict.fromkeys(ff, self)
+                if prefetched is not None and (ft, fv) in prefetched:
+                    self.data[field] = ft._build(prefetched[ft, fv], backrefs,
+                                                 prefetched)
+                elif lazy or ob.lazy:
+                    self.data[field] = proxies.foreignproxy(ft, fv, backrefs)
+                else:
+                    self.data[field] = ft(data=backrefs, primary_key=fv)
             elif fv.primary_key != original[field]:
                 # Ignore `fv` if the primary key of `fv` doesn't match that from the DB
                 # Most likely `fv` came from the `_prepare` method of another class
-                self.data[field] = ft(primary_key=original[field])
+                pk = original[field]
+                if prefetched is not None and (ft, pk) in prefetched:
+                    self.data[field] = ft._build({}, prefetched[ft, pk], prefetched)
+                elif lazy or ob.lazy:
+                    self.data[field] = proxies.foreignproxy(ft, pk)
+                else:
+                    self.data[field] = ft(primary_key=pk)
+
+    @classmethod
+    def _foreign_model(cls, field):
+        ''' Return the model referenced by the foreign field `field` '''
+        foreign = cls._foreign[field].foreign
+        return foreign if isinstance(foreign, type) else _registry[foreign]
+
+    @classmethod
+    def _prefetch(cls, records, fields, depth, consistent=False):
+        ''' Load the foreign records referenced by `fields` of `records`
+            (processed mappings) level by level, with one pipeline per model
+            on each level. On the following levels all foreign fields of the
+            loaded records are followed, up to `depth` levels in total.
+
+            Return a dictionary mapping (model, primary key) to processed data
+            (empty for missing records) suitable for _prepare. '''
+        unknown = set(fields) - cls._foreign.keys()
+        if unknown:
+            raise ValueError('Not foreign fields: {}'.format(', '.join(sorted(unknown))))
+
+        prefetched = {}
+        for record in records:
+            if cls._primary_key in record:
+                prefetched[cls, record[cls._primary_key]] = record
+
+        level = [(cls, record, fields) for record in records]
+        for _ in range(depth):
+            wanted = {}
+            for model, record, names in level:
+                for name in names:
+                    pk = record.get(name)
+                    ft = model._foreign_model(name)
+                    if pk is None or isinstance(pk, ft) or (ft, pk) in prefetched:
+                        continue
+                    wanted.setdefault(ft, {})[pk] = None
+
+            if not wanted:
+                break
+
+            level = []
+            for ft, pks in wanted.items():
+                pks = list(pks)
+                for pk, raw in zip(pks, ft._get_raw_by_pks(pks, consistent)):
+                    record = prefetched[ft, pk] = ft._process_raw(raw)
+                    if record:
+                        level.append((ft, record, list(ft._foreign)))
+
+        return prefetched
 
     @classmethod
-    def _write_unique(cls, data, pk):
-        # Must have the same order
-        keys, values, fields = [], [], []
+    def _update_arguments(cls, pk, data, previous, write=True, delete=()):
+        ''' Build keys and arguments for the 'update' script. `data` maps
+            plain and unique fields to new values, `previous` holds the old
+            values known to the client, fields `delete` are removed. Only the
+            unique indexes are changed if `write` is false. Return the
+            arguments along with the new values of unique fields in the order
+            the script checks them '''
+        unique = {k: v for k, v in data.items() if k in cls._unique_fields}
+        keys = [cls.qualified(pk=pk)]
+        keys.extend(cls._unique_keys[k] for k in unique)
+
+        if not write:
+            data, delete = {}, ()
+        indexed = [k for k in chain(data, delete) if k in cls._indexed]
+
+        args = [pk, len(unique), len(indexed), len(delete)]
+        for k, v in unique.items():
+            new = cls.serialize(cls._plain[k], v)
+            old = previous.get(k)
+            if old is not None:
+                old = cls.serialize(cls._plain[k], old)
+            args.extend((k, new if old is None else old, new))
+
+        args.extend(cls._index_arguments(indexed))
+        args.extend(delete)
         for k, v in data.items():
-            keys.append(cls._unique_keys[k])
-            fields.append(k)
-            values.append(v)
+            if k in cls._indexed:
+                cls._check_indexed(k, v)
+            args.extend((k, cls.serialize(cls._plain[k], v)))
+
+        return {'keys': keys, 'args': args}, unique
+
+    @classmethod
+    def _write_fields(cls, pk, data, previous, write=True, delete=(),
+                      client=None):
+        ''' Change plain and unique fields of the record `pk` with the
+            'update' script, see _update_arguments for the arguments. Raise
+            DuplicateEntry if a new value of a unique field is taken. Unless
+            unique fields change, the script is called on `client` (e.g. the
+            pipeline of an instance) if specified '''
+        if cls.cluster_layout:
+            return cls._write_fields_cluster(pk, data, previous, write,
+                                             delete, client)
+        conn = cls._connection(pk)
+        ka, unique = cls._update_arguments(pk, data, previous, write, delete)
+        if unique:
+            cls._check_unique(cls._scripts['update'](client=conn, **ka), unique)
+        else:
+            cls._scripts['update'](client=conn if client is None else client, **ka)
+
+    @classmethod
+    def _write_fields_cluster(cls, pk, data, previous, write, delete, client):
+        ''' _write_fields for the cluster layout, where the record hash and
+            the indexes are in different slots: read the old values, update
+            the indexes with the 'reindex' script, then write the hash '''
+        key = cls.qualified(pk=pk)
+        if not write:
+            data = {k: v for k, v in data.items() if k in cls._unique_fields}
+            delete = ()
+        save = {k: cls.serialize(cls._plain[k], v) for k, v in data.items()}
+
+        names = [k for k in chain(data, delete)
+                 if k in cls._unique_fields or k in cls._indexed]
+        if names:
+            old = {}
+            for name, stored in zip(names, cls.__redis__.hmget(key, names)):
+                known = previous.get(name)
+                if known is not None:
+                    known = cls.serialize(cls._plain[name], known)
+                old[name] = [stored, known]
+            for name in cls._indexed.keys() & data.keys():
+                cls._check_indexed(name, data[name])
+
+            new = {k: save[k] for k in names if k in save}
+            ka = cls._reindex_arguments([(pk, False, old, new)])
+            res, _ = cls._scripts['reindex'](**ka)
+            cls._check_unique(res, {k: data.get(k) for k in cls._unique_keys})
+
+        conn = client if client is not None else cls.__redis__
+        if write and delete:
+            conn.hdel(key, *delete)
+        if write and save:
+            conn.hmset(key, save)
 
-        kwargs = {'args': [pk, json.dumps(values)], 'keys': keys}
-        res = cls._scripts['unique'](**kwargs)
+    @classmethod
+    def _reindex_arguments(cls, records):
+        ''' Build keys and arguments for the 'reindex' script. `records` is
+            a list of (primary key, remove, old, new) tuples where `old` maps
+            names of unique and indexed fields to lists of their old values
+            (None for missing ones) and `new` to their new values, all of
+            them serialized. Fields in neither mapping are left alone '''
+        keys = [cls.qualified('_records')]
+        keys.extend(cls._unique_keys.values())
+        args = [len(cls._unique_keys), len(cls._indexed)]
+        args.extend(cls._index_arguments(cls._indexed))
+
+        names = list(chain(cls._unique_keys, cls._indexed))
+        for pk, remove, old, new in records:
+            args.extend((pk, int(remove)))
+            for name in names:
+                values = [x for x in old.get(name, ()) if x is not None]
+                args.append(len(values))
+                args.extend(values)
+                if name in new:
+                    args.extend((1, new[name]))
+                else:
+                    args.append(0)
+
+        return {'keys': keys, 'args': args}
+
+    @classmethod
+    def _index_arguments(cls, names):
+        ''' Return the field name, index type and key (or key prefix)
+            triples the scripts use to maintain the indexes of `names` '''
+        args = []
+        for name in names:
+            if cls._indexed[name].index == 'range':
+                args.extend((name, 'range', cls.qualified('_range', name)))
+            else:
+                args.extend((name, 'set', cls.qualified('_index', name, '')))
+        return args
+
+    @classmethod
+    def _index_key(cls, name, value):
+        ''' Return the key of the index of field `name` that holds
+            records with `value` '''
+        if cls._indexed[name].index == 'range':
+            return cls.qualified('_range', name)
+        prefix = cls.qualified('_index', name, '')
+        raw = cls.serialize(cls._plain[name], value)
+        if isinstance(raw, bytes):
+            return prefix.encode(cls.encoding) + raw
+        return prefix + raw
+
+    @classmethod
+    def _check_indexed(cls, name, value):
+        ''' Raise ValueError if `value` can't be stored in the index
+            of field `name`. The scripts would fail halfway otherwise '''
+        if cls._indexed[name].index == 'range':
+            try:
+                if math.isnan(float(value)):
+                    raise ValueError
+            except (TypeError, ValueError):
+                raise ValueError('Range index of {!r} requires numeric values, '
+                                 'got {!r}'.format(name, value)) from None
+
+    @staticmethod
+    def _check_unique(res, data):
+        ''' Raise DuplicateEntry if the 'update' script failed '''
         # 0 for success
         # 1 ... len(fields) is an error
         #       (position of the first duplicate field from 'fields')
         if res:
-            res -= 1
-            raise exceptions.DuplicateEntry(fields[res], values[res])
+            field = list(data)[res - 1]
+            raise exceptions.DuplicateEntry(field, data[field])
 
     @classmethod
-    def _write_pk(cls, pk, score=None):
+    def _new_arguments(cls, pk, score, ka):
+        ''' Build keys and arguments for the 'new' script. Return them along
+            with the list of unique fields in the order the script checks them '''
         if score is None:
             score = time.time()
-        result = cls._scripts['primary_key'](
-            args=[score, pk], keys=[cls.qualified('_records')])
 
-        if not result:
-            raise exceptions.DuplicateEntry
+        unique = [k for k in cls._unique_fields if k in ka]
+        indexed = [k for k in cls._indexed if k in ka]
+
+        if cls.cluster_layout:
+            # The record is written by the 'record' script, the main hash
+            # is replaced with a key from the same slot as the indexes
+            record = {'keys': [cls.qualified('_records')], 'args': [0]}
         else:
-            return result
+            record = cls._record_arguments(pk, ka)
+        size = 1 + 2 * record['args'][0]
+
+        keys = [cls.qualified('_records'), record['keys'][0]]
+        keys.extend(cls._unique_keys[k] for k in unique)
+        keys.extend(cls._index_key(k, ka[k]) for k in indexed)
+        keys.extend(record['keys'][1:])
+
+        args = [score, pk, len(unique), record['args'][0], len(indexed)]
+        args.extend(cls.serialize(cls._plain[k], ka[k]) for k in unique)
+        args.extend(record['args'][1:size])
+
+        # Indexes
+        for field in indexed:
+            if cls._indexed[field].index == 'range':
+                cls._check_indexed(field, ka[field])
+                args.extend(('ZADD', 2, ka[field], pk))
+            else:
+                args.extend(('SADD', 1, pk))
+
+        # Standalone fields
+        args.extend(record['args'][size:])
+        return {'keys': keys, 'args': args}, unique
+
+    @classmethod
+    def _record_arguments(cls, pk, ka):
+        ''' Build keys and arguments for the 'record' script, which writes
+            the main hash and the standalone keys of a new record '''
+        standalone = [k for k in cls._standalone if k in ka]
+        keys = [cls.qualified(pk=pk)]
+        keys.extend(cls.qualified(k, pk=pk) for k in standalone)
+
+        # Unique and plain fields
+        save = {cls._primary_key: pk}
+        for field in cls._plain.keys() & ka.keys():
+            save[field] = cls.serialize(cls._plain[field], ka[field])
+
+        args = [len(save)]
+        args.extend(x for pair in save.items() for x in pair)
+
+        # Standalone fields
+        for field in standalone:
+            ob = cls._standalone[field]
+            values = ob.flatten(ka[field])
+            args.extend((ob.command, len(values)))
+            args.extend(values)
+
+        return {'keys': keys, 'args': args}
+
+    @classmethod
+    def _check_new(cls, result, unique, ka):
+        ''' Raise DuplicateEntry if the 'new' script failed '''
+        # 0 for success
+        # -1 if the primary key is taken
+        # 1 ... len(unique) is the position of the first duplicate field
+        if result < 0:
+            field = cls._primary_key
+            raise exceptions.DuplicateEntry(field, ka[field])
+        elif result:
+            field = unique[result - 1]
+            raise exceptions.DuplicateEntry(field, ka[field])
 
     @classmethod
     def _remove_pk(cls, pk, connection=None):
-        conn = connection if connection is not None else cls.__redis__
+        conn = connection if connection is not None else cls._connection(pk)
         return conn.zrem(cls.qualified('_records'), pk)
 
     def _update_plain(self, new_data):
-        save = new_data.copy()
-        for k, v in save.items():
-            save[k] = self.serialize(self._plain[k], v)
-        self.redis.hmset(self.qualified(pk=self.primary_key), save)
+        if new_data.keys() & self._indexed.keys():
+            # Moves the record between indexes as well
+            self._write_fields(self.primary_key, new_data, self.data,
+                               client=self.redis)
+        else:
+            save = new_data.copy()
+            for k, v in save.items():
+                save[k] = self.serialize(self._plain[k], v)
+            self.redis.hmset(self.qualified(pk=self.primary_key), save)
         self.data.update(new_data)
+        self._invalidate()
 
     def _update_unique(self, new_data):
-        self._write_unique(new_data, self.primary_key)
-        self._update_plain(new_data)
+        # Inside `with self:` the unique indexes are changed immediately,
+        # and the record hash is written by the pipeline
+        deferred = isinstance(self.redis, redis.client.Pipeline)
+        self._write_fields(self.primary_key, new_data, self.data,
+                           write=not deferred)
+        if deferred:
+            self._update_plain(new_data)
+        else:
+            self.data.update(new_data)
+            self._invalidate()
+
+    def _defer(self, field, value):
+        ''' Apply the assignment of `value` to `field` to this instance only '''
+        if field.standalone:
+            values, value = self._field_cache, field._wrap(self, value)
+        else:
+            values = self.data
+        self._changes.setdefault(field.name, values.get(field.name, _missing))
+        values[field.name] = value
+
+    def dirty(self):
+        ''' Return the names of fields with unsaved changes '''
+        return set(self._changes)
+
+    def save(self):
+        ''' Write unsaved changes of plain, unique and auto fields in one
+            transaction. If any unique field changed, plain and unique fields
+            are written first by a separate script call, which claims the new
+            values: if one of them is taken, DuplicateEntry is raised and the
+            changes are kept, otherwise these fields are saved even if writing
+            the rest fails (and only the rest stays unsaved). '''
+        if not self._changes:
+            return
+        if not self.good():
+            raise ValueError
+
+        names = list(self._changes)
+        plain = {k: self.data[k] for k in names if k in self._plain}
+        previous = {k: v for k, v in self._changes.items() if v is not _missing}
+        if plain.keys() & self._unique_fields.keys():
+            # Claim the unique values, write the record hash
+            # and update the indexes at once
+            self._write_fields(self.primary_key, plain, previous)
+            for name in plain:
+                del self._changes[name]
+            self._invalidate()
+            plain = {}
+
+        with self:
+            if plain.keys() & self._indexed.keys():
+                # Moves the record between indexes in the same transaction
+                self._write_fields(self.primary_key, plain, previous,
+                                   client=self.redis)
+            elif plain:
+                save = {k: self.serialize(self._plain[k], v) for k, v in plain.items()}
+                self.redis.hmset(self.qualified(pk=self.primary_key), save)
+            for name in names:
+                if name in self._standalone_auto:
+                    key = self.qualified(name, pk=self.primary_key)
+                    self._standalone_auto[name].save(key, self.redis,
+                                                     self._field_cache[name])
+        for name in names:
+            if name in self._standalone_auto and self._standalone_auto[name].lazy:
+                self._field_cache.pop(name, None)
+        self._changes.clear()
+
+    def discard(self):
+        ''' Revert unsaved changes of this instance '''
+        for name, value in self._changes.items():
+            if name in self._standalone:
+                values = self._field_cache
+                if value is not _missing:
+                    value = self._standalone[name]._wrap(self, value)
+            else:
+                values = self.data
+            if value is _missing:
+                values.pop(name, None)
+            else:
+                values[name] = value
+        self._changes.clear()
 
     def _delete_plain(self, fields):
-        if fields:
+        if not fields:
+            return
+        if self._indexed.keys() & set(fields):
+            self._write_fields(self.primary_key, {}, self.data,
+                               delete=list(fields), client=self.redis)
+        else:
             self.redis.hdel(self.qualified(pk=self.primary_key), *fields)
+        self._invalidate()
+
+    def _invalidate(self):
+        ''' Remove the record and its auto fields from the cache of the model '''
+        if self._cache is not None and self.good():
+            self._invalidate_pk(self.primary_key)
+
+    @classmethod
+    def _invalidate_pk(cls, pk):
+        cls._cache.invalidate(pk)
+        for name in cls._standalone_auto:
+            cls._cache.invalidate((pk, name))
+
+    @classmethod
+    def _invalidate_key(cls, rest):
+        ''' Remove whatever is stored at key `cls.qualified(pk='') + rest`
+            from the cache of the model '''
+        # The record hash
+        cls._cache.invalidate(rest)
+        # An auto field
+        pk, sep, name = rest.rpartition(cls._field_sep)
+        if sep and name in cls._standalone_auto:
+            cls._cache.invalidate((pk, name))
+
+    def _fetch_auto(self, field):
+        ''' Return the reply to the request for the auto field `field`,
+            reading through the cache of the model '''
+        cached = (self.primary_key, field.name)
+        if self._cache is not None:
+            version = self._cache.version
+            reply = self._cache.get(cached)
+            if reply is not None:
+                return reply
+
+        key = self.qualified(field.name, pk=self.primary_key)
+        conn = self._reader(self.primary_key)
+        reply = field.request(key, conn)
+        if reply is not None and self._cache is not None and conn is self.__redis__:
+            self._cache.set(cached, reply, version)
+        return reply
+
+    @classmethod
+    def cache_info(cls):
+        ''' Return hit, miss, eviction and expiration counters and the size
+            of the cache, or None if caching is disabled for this model '''
+        if cls._cache is not None:
+            return cls._cache.info()
+
+    @classmethod
+    def cache_clear(cls):
+        if cls._cache is not None:
+            cls._cache.clear()
 
     def _delete_unique(self, fields):
+        if self.cluster_layout:
+            # The unique indexes are in another slot
+            self._write_fields(self.primary_key, {}, self.data,
+                               delete=list(fields), client=self.redis)
+            self._invalidate()
+            return
         for f in fields:
-            self.redis.hdel(self.qualified(f), self.data[f])
+            self.redis.hdel(self.qualified(f), self.serialize(self._plain[f], self.data[f]))
         self._delete_plain(fields)
         
     @classmethod
     def serialize(cls, ob, value):
-        ''' Equivalent to ob.serialize(value, cls.encoding) but shorter '''
+        ''' Equivalent to ob.serialize(value, cls.encoding) but shorter
+            (and using the codec of the model for container fields) '''
+        codec = cls._codecs.get(ob)
+        if codec is not None:
+            return ob.serialize(value, cls.encoding, codec)
         return ob.serialize(value, cls.encoding)
 
     @classmethod
@@ -271,14 +940,31 @@ class Model(metaclass=MetaModel):
         return rv
 
     @classmethod
-    def get_pipeline(cls):
+    def get_pipeline(cls, transaction=True):
         ''' Return a Pipeline instance for the specified Redis connection '''
-        return cls.__redis__.pipeline()
+        if cls._shards is not None:
+            raise exceptions.UnsupportedOperation('{} is sharded, use the pipelines'
+                                                  ' of its shards'.format(cls.__name__))
+        return cls.__redis__.pipeline(transaction=transaction)
+
+    def _pipeline(self):
+        ''' Return a transaction for the server that holds this record '''
+        conn = self.__redis__
+        if cluster.is_cluster(conn):
+            # Cluster pipelines can't be transactions, the node that owns
+            # the slot of the record can run one
+            node = conn.get_node_from_key(self.qualified(pk=self.primary_key))
+            conn = conn.get_redis_connection(node)
+        return conn.pipeline(transaction=True)
 
     @classmethod
-    def count(cls):
-        ''' Return the number of elements in 'model_name : _records' '''
-        return cls.__redis__.zcard(cls.qualified('_records'))
+    def count(cls, consistent=False):
+        ''' Return the number of elements in 'model_name : _records'
+            (the sum for all shards of sharded models) '''
+        key = cls.qualified('_records')
+        if cls._shards is not None:
+            return sum(cls._shards.map(lambda x: x.zcard(key)))
+        return cls._reader(consistent=consistent).zcard(key)
 
     @property
     def primary_key(self):
@@ -291,10 +977,20 @@ class Model(metaclass=MetaModel):
     def qualified(cls, *args, pk=None):
         ''' Return a fully qualified name. `cls._field_sep` is used as a separator.
             Example for ':':    model_name : ... : ... : ...
-            If `pk` is not `None`, it will follow the model name immediately. '''
-        parts = [cls.__name__]
-        if pk is not None:
-            parts.append(pk)
+            If `pk` is not `None`, it will follow the model name immediately.
+            In the cluster layout the primary key, or the model name if there's
+            no primary key, is a hash tag:  model_name : {pk} : ...
+            (see cluster.hash_tag) '''
+        if not cls.cluster_layout:
+            parts = [cls.__name__]
+            if pk is not None:
+                parts.append(pk)
+        elif pk is not None:
+            # Model : {pk} : ...
+            parts = [cls.__name__, cluster.hash_tag(pk)]
+        else:
+            # {Model} : ...
+            parts = [cluster.hash_tag(cls.__name__)]
         parts.extend(args)
         return cls._field_sep.join(parts)
 
@@ -308,22 +1004,44 @@ class Model(metaclass=MetaModel):
             return cls(primary_key=ob)
 
     @classmethod
-    def instances(cls, it):
-        # TODO: Optimize this using pipelines?
+    def instances(cls, it, chunk_size=500, consistent=False):
         ''' Return a generator object converting iterable `it` on the fly and 
-            yielding instances of `cls` '''
-        yield from (cls.instance(x) for x in it)
+            yielding instances of `cls`. Mappings and instances of `cls` are
+            converted without I/O, primary keys are loaded in pipelines of up
+            to `chunk_size` elements. '''
+        local = (Mapping, cls)
+        it = iter(it)
+        while True:
+            chunk = list(islice(it, chunk_size))
+            if not chunk:
+                break
+
+            pks = [x for x in chunk if not isinstance(x, local)]
+            raw = iter(cls._get_raw_by_pks(pks, consistent) if pks else ())
+            for ob in chunk:
+                if isinstance(ob, local):
+                    yield cls.instance(ob)
+                    continue
+
+                data = next(raw)
+                if data:
+                    yield cls(data=cls._process_raw(data))
+                else:
+                    # Missing record, the pipeline already answered
+                    yield cls._build({}, {})
 
     @classmethod
-    def new(cls, **ka):
-        ''' Create and store a new instance of this model.
-            All of the required fields must be provided. '''
+    def _new_prepare(cls, ka):
+        ''' Validate keyword arguments of `new` and split the primary key.
+            Return the primary key, the score, the data for the instance and
+            the data to store '''
         if cls._required_fields.keys() - ka.keys():
             raise exceptions.MissingFields('Some of the required fields are missing')
             
         if cls._primary_key not in ka:
             raise exceptions.NoPrimaryKey('The primary key must be specified')
 
+        ka = dict(ka)
         # Primary key can also be provided as a tuple (score, pk_value)
         # If that's the case, `score` will be used in
         # _records SortedSet in Redis
@@ -332,10 +1050,18 @@ class Model(metaclass=MetaModel):
         if isinstance(pk, tuple):
             score, pk = pk
             ka[cls._primary_key] = pk
+            # The script would fail after other records of the pipeline
+            try:
+                if math.isnan(float(score)):
+                    raise ValueError
+            except (TypeError, ValueError):
+                raise ValueError('Invalid score {!r}'.format(score)) from None
         else:
             score = None
 
-        cls._write_pk(pk, score)
+        if cls.cluster_layout and pk == '':
+            # An empty hash tag doesn't choose the slot
+            raise ValueError('The primary key can\'t be empty in the cluster layout')
 
         data = ka.copy()
         data[cls._primary_key] = pk
@@ -347,50 +1073,182 @@ class Model(metaclass=MetaModel):
             except AttributeError:
                 continue
 
-        main_key = cls.qualified(pk=pk)
+        return pk, score, data, ka
 
-        # Unique fields
-        if cls._unique_fields:
-            unique = {k: ka[k] for k in 
-                     cls._unique_keys.keys() & ka.keys()}
-            cls._write_unique(unique, pk)
-
-        # Standalone fields
-        with cls.get_pipeline() as pipe:
-            for field in cls._standalone.keys() & ka.keys():
-                value, ob = ka[field], cls._standalone[field]
-                # You can't setattr() to a proxy
-                ob.save(cls.qualified(field, pk=pk), pipe, value)
-                
-            pipe.execute()
+    @classmethod
+    def new(cls, **ka):
+        ''' Create and store a new instance of this model.
+            All of the required fields must be provided. '''
+        pk, score, data, ka = cls._new_prepare(ka)
+        # The primary key, unique, plain and standalone fields
+        # are all written by a single script call
+        # (two in the cluster layout, one per slot)
+        script_ka, unique = cls._new_arguments(pk, score, ka)
+        res = cls._scripts['new'](client=cls._connection(pk), **script_ka)
+        cls._check_new(res, unique, ka)
+        if cls.cluster_layout:
+            cls._scripts['record'](**cls._record_arguments(pk, ka))
+        instance = cls(data=data)
+        instance._invalidate()
+        return instance
 
-        # Unique and plain fields
-        save = {cls._primary_key: pk}
-        for field in cls._plain.keys() & ka.keys():
-            value = ka[field]
-            save[field] = cls.serialize(cls._plain[field], value)
+    @classmethod
+    def new_many(cls, it, batch_size=500):
+        ''' Create and store new instances of this model for every mapping
+            in the iterable `it`. Records are validated locally and written
+            in pipelines of `batch_size` records.
+
+            Return a generator object yielding, in order, either the new
+            instance or the exception (MissingFields, NoPrimaryKey,
+            DuplicateEntry, ValueError for invalid scores and values an
+            index can't store) that prevented the creation of the record.
+            Errors don't affect other records.
+
+            The generator is lazy: nothing is written until it's iterated,
+            and each batch is written when its first result is needed.
+            Consume it (e.g. with list()) even if you don't need the results. '''
+        if batch_size < 1:
+            raise ValueError('batch_size must be positive')
+
+        it = iter(it)
+        while True:
+            batch = list(islice(it, batch_size))
+            if not batch:
+                break
+
+            results, pending, calls = [], [], []
+            for ka in batch:
+                try:
+                    pk, score, data, ka = cls._new_prepare(ka)
+                    script_ka, unique = cls._new_arguments(pk, score, ka)
+                except (exceptions.FusedError, ValueError) as e:
+                    results.append(e)
+                    continue
+                calls.append(cls._script_call('new', script_ka, pk))
+                pending.append((len(results), pk, data, unique, ka))
+                results.append(None)
+
+            records = []
+            for (res,), (pos, pk, data, unique, ka) in zip(
+                    cluster.execute(cls.__redis__, calls), pending):
+                try:
+                    cls._check_new(res, unique, ka)
+                except exceptions.DuplicateEntry as e:
+                    results[pos] = e
+                else:
+                    results[pos] = cls(data=data)
+                    records.append(cls._script_call(
+                        'record', cls._record_arguments(pk, ka), pk))
 
-        cls.__redis__.hmset(main_key, save)
+            if cls.cluster_layout and records:
+                # Records are written once the indexes accepted them
+                cluster.execute(cls.__redis__, records)
+            for ob in results:
+                if isinstance(ob, cls):
+                    ob._invalidate()
 
-        return cls(data=data)
+            yield from results
 
     def delete(self):
         '''  Completely delete the instance of this Model from Redis '''
         if not self.good():
             raise ValueError
 
+        if self.cluster_layout:
+            # The indexes and the record are in different slots
+            self.delete_many([self.primary_key])
+            self._field_cache.clear()
+            self.data.clear()
+            return
+
         with self:
             for name, ob in self._standalone.items():
                 delattr(self, name)
 
             self._delete_unique(self._unique_fields)
+            self._delete_plain(list(self._indexed))
             self._remove_pk(self.primary_key, connection=self.redis)
             self.redis.delete(self.qualified(pk=self.primary_key))
 
         self.data.clear()
 
     @classmethod
-    def get(cls, pks=None, start=None, stop=None, offset=None, limit=None, **ka):
+    def _delete_arguments(cls):
+        ''' Build keys and arguments (except for primary keys)
+            for the 'delete_many' script '''
+        keys = [cls.qualified('_records')]
+        keys.extend(cls._unique_keys.values())
+        args = [cls.qualified(pk=''), cls._field_sep, len(cls._unique_keys),
+                len(cls._standalone), len(cls._indexed)]
+        args.extend(cls._unique_keys)
+        args.extend(cls._standalone)
+        args.extend(cls._index_arguments(cls._indexed))
+        return keys, args
+
+    @classmethod
+    def delete_many(cls, pks, batch_size=1000):
+        ''' Completely delete records with primary keys `pks` without loading
+            them, `batch_size` records per script call. Return the number of
+            records that existed '''
+        if batch_size < 1:
+            raise ValueError('batch_size must be positive')
+
+        keys, head = cls._delete_arguments()
+        deleted, it = 0, iter(pks)
+        for batch in iter(lambda: list(islice(it, batch_size)), []):
+            if cls.cluster_layout:
+                deleted += cls._delete_cluster(batch)
+            elif cls._shards is not None:
+                groups = cls._shards.group(batch)
+                deleted += sum(cls._shards.map(lambda x: cls._scripts['delete_many'](
+                    keys=keys, args=head + groups[x], client=x), groups))
+            else:
+                deleted += cls._scripts['delete_many'](keys=keys, args=head + batch)
+            if cls._cache is not None:
+                for pk in batch:
+                    cls._invalidate_pk(pk)
+
+        return deleted
+
+    @classmethod
+    def _delete_cluster(cls, pks):
+        ''' delete_many for the cluster layout: read the values of unique and
+            indexed fields, remove the records from the indexes with the
+            'reindex' script, then delete the keys of the records (grouped by
+            node). Return the number of records that existed '''
+        names = list(chain(cls._unique_keys, cls._indexed))
+        if names:
+            with cls.get_pipeline(transaction=False) as pipe:
+                for pk in pks:
+                    pipe.hmget(cls.qualified(pk=pk), names)
+                stored = pipe.execute()
+        else:
+            stored = [()] * len(pks)
+
+        records = [(pk, True, {k: [v] for k, v in zip(names, values)}, {})
+                   for pk, values in zip(pks, stored)]
+        _, removed = cls._scripts['reindex'](**cls._reindex_arguments(records))
+
+        calls = []
+        for pk in pks:
+            keys = [cls.qualified(pk=pk)]
+            keys.extend(cls.qualified(k, pk=pk) for k in cls._standalone)
+            calls.append((keys[0], lambda pipe, keys=keys: pipe.delete(*keys)))
+        cluster.execute(cls.__redis__, calls)
+        return removed
+
+    @classmethod
+    def _script_call(cls, name, ka, pk):
+        ''' Return a call of the script `name` with keys and arguments `ka`
+            for the record `pk` for cluster.execute '''
+        route = pk if cls._shards is not None else ka['keys'][0]
+        return route, lambda pipe: cls._scripts[name](client=pipe, **ka)
+
+    @classmethod
+    def get(cls, pks=None, start=None, stop=None, offset=None, limit=None,
+            chunk_size=None, prefetch=False, prefetch_related=None,
+            prefetch_depth=2, lazy_foreign=False, with_fields=None, rows=False,
+            consistent=False, **ka):
         ''' Fetch a number of instances from Redis.
 
             1) `pks` is an iterable of primary keys
@@ -405,11 +1263,44 @@ class Model(metaclass=MetaModel):
             this model and `value` is an iterable of values to search for.
 
             These groups of parameters are mutually exclusive.
+
+            If `chunk_size` is not None, records are loaded and yielded
+            `chunk_size` at a time instead of all at once. If `prefetch` is
+            true as well, the next chunk is loaded in a background thread
+            while the current one is being consumed.
+
+            `prefetch_related` is a list of foreign fields. Records they reference
+            are loaded for all instances (of each chunk) at once, following
+            relations of the loaded records up to `prefetch_depth` levels deep,
+            instead of one request per foreign field per instance.
+
+            If `lazy_foreign` is true, other foreign fields of the instances
+            are loaded on first access, as if they were declared lazy.
+
+            Values of auto fields listed in `with_fields` (which can't be
+            lazy) are loaded for all instances (of each chunk) in one pipeline.
+
+            If `rows` is true, get yields compact immutable rows (see Row)
+            instead of instances. Rows hold values of plain fields (primary keys
+            for foreign fields, None for missing values) and can't be combined
+            with the options above that load more data.
+
+            If `consistent` is true, everything is read from the primary
+            instead of the read replicas (see `redis_read`).
         '''
 
         z = any(x is not None for x in (start, stop, offset, limit))
         if sum((z, pks is not None, len(ka) == 1)) != 1:
             raise ValueError
+
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError('chunk_size must be positive')
+
+        if rows and (prefetch_related or lazy_foreign or with_fields):
+            raise ValueError('Rows can only hold plain fields')
+
+        if with_fields:
+            cls._check_auto(with_fields)
             
         key = cls.qualified('_records')
 
@@ -420,32 +1311,341 @@ class Model(metaclass=MetaModel):
             if stop is None:
                 stop = '+inf'
 
-            pks = [cls.deserialize(PrimaryKey, x) for x in
-                   cls.__redis__.zrangebyscore(key, start, stop, start=offset,
-                                               num=limit)]
+            # Primary keys are fetched a chunk at a time as well
+            pages = cls._range_pages(key, start, stop, offset, limit,
+                                     chunk_size, consistent)
+            chunks = ([cls.deserialize(PrimaryKey, x) for x in page]
+                      for page in pages)
+        else:
+            if pks is not None:
+                it = iter(pks)
+            else:
+                field, values = ka.popitem()
+                it = iter(values)
+
+            if chunk_size is None:
+                chunks = [list(it)]
+            else:
+                chunks = iter(lambda: list(islice(it, chunk_size)), [])
 
-        if pks is not None:
-            it = pks
+        if pks is not None or z:
+            load = partial(cls._get_raw_by_pks, consistent=consistent)
         else:
-            field, values = ka.popitem()
-            with cls.get_pipeline() as pipe:
-                for v in values:
-                    cls._get_raw_pk_by_unique(field, v, pipe)
-                it = (cls.deserialize(PrimaryKey, x) for x in pipe.execute())
+            load = partial(cls._get_raw_by_uniques, field, consistent=consistent)
+
+        for raw in cls._load_chunks(load, chunks, prefetch):
+            # Missing records, including records deleted since their
+            # primary keys were read, are skipped
+            raw = [r for r in raw if r]
+            if rows:
+                yield from (cls._row._from_data(cls._process_raw(r)) for r in raw)
+                continue
 
-        with cls.get_pipeline() as pipe:
-            for x in it:
-                cls._get_raw_by_pk(x, pipe)
-            raw = pipe.execute()
+            records = [cls._process_raw(r) for r in raw]
+            if prefetch_related or lazy_foreign:
+                prefetched = cls._prefetch(records, prefetch_related or (),
+                                           prefetch_depth, consistent)
+                instances = (cls._build({}, r, prefetched, lazy_foreign)
+                             for r in records)
+            else:
+                instances = cls.instances(records)
+
+            if with_fields:
+                instances = list(instances)
+                cls._load_auto(instances, with_fields, consistent)
+
+            yield from instances
 
-        yield from cls.instances(cls._process_raw(r) for r in raw)
+    @classmethod
+    def filter(cls, *, chunk_size=500, consistent=False, **conditions):
+        ''' Yield instances whose indexed fields have the given values
+            (loaded `chunk_size` at a time, see `get`). Records must match
+            all conditions, a list, tuple or set of values matches any of them.
+
+            Example:    Model.filter(status='pending', kind=['a', 'b']) '''
+        if not conditions:
+            raise ValueError('No conditions')
+        unknown = {k for k in conditions
+                   if k not in cls._indexed or cls._indexed[k].index == 'range'}
+        if unknown:
+            raise ValueError('Fields without a set index: '
+                             '{}'.format(', '.join(sorted(unknown))))
+
+        keys, counts = [], []
+        for name, value in conditions.items():
+            if not isinstance(value, (list, tuple, set, frozenset)):
+                value = [value]
+            if not value:
+                return iter(())
+            keys.extend(cls._index_key(name, x) for x in value)
+            counts.append(len(value))
+
+        if cls._shards is not None:
+            pks = chain.from_iterable(cls._shards.map(lambda x: cls._scripts['filter'](
+                keys=keys, args=counts, client=x)))
+        else:
+            pks = cls._scripts['filter'](keys=keys, args=counts,
+                                         client=cls._reader(consistent=consistent))
+        return cls.get(pks=[cls.deserialize(PrimaryKey, x) for x in pks],
+                       chunk_size=chunk_size, consistent=consistent)
+
+    @classmethod
+    def range(cls, field, min='-inf', max='+inf', offset=None, limit=None,
+              reverse=False, pks_only=False, chunk_size=500, consistent=False):
+        ''' Yield instances whose field `field` (that must have a range
+            index) is between `min` and `max`, ordered by the value. Bounds
+            are inclusive unless prefixed with '(' as in ZRANGEBYSCORE.
+            Return the list of primary keys instead if `pks_only` is true.
+
+            Example:    Model.range('price', 10, '(20', limit=100) '''
+        if field not in cls._indexed or cls._indexed[field].index != 'range':
+            raise ValueError('{!r} has no range index'.format(field))
+        if offset is not None or limit is not None:
+            offset = offset or 0
+            limit = -1 if limit is None else limit
+
+        raw = cls._range_members(cls.qualified('_range', field), min, max,
+                                 offset, limit, reverse, consistent)
+        pks = [cls.deserialize(PrimaryKey, x) for x in raw]
+        if pks_only:
+            return pks
+        return cls.get(pks=pks, chunk_size=chunk_size, consistent=consistent)
+
+    @classmethod
+    def _range_members(cls, key, min, max, offset=None, limit=None,
+                       reverse=False, consistent=False, withscores=False):
+        ''' Return members of the sorted set `key` with scores between `min`
+            and `max` (see ZRANGEBYSCORE), merged from all shards of sharded
+            models. Return (member, score) pairs if `withscores` is true '''
+        if cls._shards is None:
+            conn = cls._reader(consistent=consistent)
+            if reverse:
+                return conn.zrevrangebyscore(key, max, min, start=offset, num=limit,
+                                             withscores=withscores)
+            return conn.zrangebyscore(key, min, max, start=offset, num=limit,
+                                      withscores=withscores)
+
+        # Every shard returns its first `offset + limit` elements
+        if limit is None or limit < 0:
+            start = num = None
+        else:
+            start, num = 0, (offset or 0) + limit
+
+        def load(connection):
+            if reverse:
+                return connection.zrevrangebyscore(key, max, min, start=start,
+                                                   num=num, withscores=True)
+            return connection.zrangebyscore(key, min, max, start=start,
+                                            num=num, withscores=True)
+
+        merged = cls._merge(cls._shards.map(load), reverse)
+        if withscores:
+            return merged[offset or 0:num]
+        return [member for member, _ in merged[offset or 0:num]]
+
+    @classmethod
+    def _range_pages(cls, key, start, stop, offset=None, limit=None,
+                     page_size=None, consistent=False):
+        ''' Yield members of the sorted set `key` with scores between `start`
+            and `stop` (see _range_members) in lists of at most `page_size`
+            elements, loaded one at a time. If `page_size` is None, all of
+            them are loaded at once.
+
+            Pages after the first one continue after the last element of
+            the previous page (see _page), so their cost doesn't depend on
+            how deep they are and removed elements don't shift them. '''
+        if page_size is None:
+            yield cls._range_members(key, start, stop, offset, limit,
+                                     consistent=consistent)
+            return
+
+        remaining = limit if limit is not None and limit >= 0 else None
+        num = page_size if remaining is None else min(page_size, remaining)
+        page = cls._range_members(key, start, stop, offset or 0, num,
+                                  consistent=consistent, withscores=True)
+        while page:
+            yield [member for member, _ in page]
+            if remaining is not None:
+                remaining -= len(page)
+            if len(page) < num or remaining == 0:
+                break
+
+            num = page_size if remaining is None else min(page_size, remaining)
+            member, score = page[-1]
+            res = cls._page(key, num, [score, member], consistent=consistent)
+            # Elements are ordered by score, stop at the first one above `stop`
+            page = list(takewhile(lambda x: cls._below(x[1], stop),
+                                  zip(res[::2], res[1::2])))
+
+    @staticmethod
+    def _below(score, bound):
+        ''' Return true if `score` is within the upper bound `bound` of
+            ZRANGEBYSCORE (exclusive if prefixed with '(') '''
+        if isinstance(bound, bytes):
+            bound = bound.decode()
+        bound = str(bound)
+        if bound.startswith('('):
+            return float(score) < float(bound[1:])
+        return float(score) <= float(bound)
+
+    @classmethod
+    def _page(cls, key, limit, after=None, reverse=False, consistent=False):
+        ''' Return up to `limit` members of the sorted set `key` following
+            the element `after` ([score, member], the first ones if None) with
+            their scores, as a flat list (see the 'page' script), merged from
+            all shards of sharded models '''
+        args = [limit, int(bool(reverse))]
+        if after is not None:
+            args.extend(after)
+
+        if cls._shards is not None:
+            # The first `limit` elements following `after` on all shards
+            pages = cls._shards.map(lambda x: cls._scripts['page'](
+                keys=[key], args=args, client=x))
+            merged = cls._merge([zip(r[::2], r[1::2]) for r in pages], reverse)
+            return [x for pair in merged[:limit] for x in pair]
+        return cls._scripts['page'](keys=[key], args=args,
+                                    client=cls._reader(consistent=consistent))
+
+    @staticmethod
+    def _merge(results, reverse=False):
+        ''' Merge iterables of (member, score) pairs from sorted sets of
+            different shards, each in the order of its sorted set '''
+        return list(heapq.merge(*results, key=lambda x: (float(x[1]), x[0]),
+                                reverse=reverse))
+
+    @classmethod
+    def iterate(cls, after=None, limit=100, reverse=False, consistent=False):
+        ''' Fetch a page of at most `limit` instances ordered by the scores
+            in 'model_name : _records' (in descending order if `reverse`
+            is true).
+
+            `after` is the continuation token returned by the previous call
+            or None for the first page. Return a tuple of the list of instances
+            and the token for the next page, which is None if there are no
+            more records. Unlike `offset` in `get`, the cost of a page doesn't
+            depend on how deep it is. '''
+        if limit < 1:
+            raise ValueError('limit must be positive')
+
+        if after is not None:
+            after = cls._decode_cursor(after)
+        res = cls._page(cls.qualified('_records'), limit, after, reverse,
+                        consistent)
+        pks = [cls.deserialize(PrimaryKey, x) for x in res[::2]]
+        instances = list(cls.get(pks, consistent=consistent))
+        if len(pks) < limit:
+            return instances, None
+        return instances, cls._encode_cursor(res[-1], res[-2])
+
+    @classmethod
+    def _encode_cursor(cls, score, member):
+        ''' Pack the score and the member of the last element of
+            a page into an opaque string '''
+        parts = [x if isinstance(x, bytes) else x.encode(cls.encoding)
+                 for x in (score, member)]
+        return base64.urlsafe_b64encode(b'\n'.join(parts)).decode('ascii')
+
+    @staticmethod
+    def _decode_cursor(token):
+        ''' Inverse of _encode_cursor. Return a list [score, member] '''
+        try:
+            raw = base64.urlsafe_b64decode(token)
+        except (TypeError, ValueError):
+            raise ValueError('Invalid cursor {!r}'.format(token))
+        score, sep, member = raw.partition(b'\n')
+        if not sep:
+            raise ValueError('Invalid cursor {!r}'.format(token))
+        return [score, member]
+
+    @staticmethod
+    def _load_chunks(load, chunks, prefetch=False):
+        ''' Yield the result of `load` for every element of `chunks`. If
+            `prefetch` is true, the next chunk is loaded in a separate
+            thread before the result for the current chunk is yielded. '''
+        if not prefetch:
+            yield from map(load, chunks)
+            return
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            current = None
+            for chunk in chunks:
+                # Keep reading from the primary inside replica.consistent()
+                upcoming = executor.submit(replica.bind(load), chunk)
+                if current is not None:
+                    yield current.result()
+                current = upcoming
+
+            if current is not None:
+                yield current.result()
+
+    def load(self, *fields, consistent=False):
+        ''' Fetch the values of auto fields `fields` (all auto fields
+            that aren't lazy if none are specified) in one pipeline and
+            cache them '''
+        self._load_auto([self], fields or self._eager_auto, consistent)
+
+    @classmethod
+    def _check_auto(cls, fields):
+        ''' Raise ValueError unless `fields` are auto fields that aren't lazy.
+            Loading a lazy field would replace its view with the whole value '''
+        unknown = set(fields) - cls._standalone_auto.keys()
+        if unknown:
+            raise ValueError('Not auto fields: {}'.format(', '.join(sorted(unknown))))
+        lazy = {x for x in fields if cls._standalone_auto[x].lazy}
+        if lazy:
+            raise ValueError('Lazy fields are read on access: '
+                             '{}'.format(', '.join(sorted(lazy))))
+
+    @classmethod
+    def _load_auto(cls, instances, fields, consistent=False):
+        ''' Fetch the values of auto fields `fields` for all `instances`
+            in one pipeline and cache them '''
+        cls._check_auto(fields)
+
+        wanted = [(ob, name) for ob in instances if ob.good() for name in fields]
+        if cls._cache is None:
+            replies = [None] * len(wanted)
+        else:
+            version = cls._cache.version
+            replies = [cls._cache.get((ob.primary_key, name)) for ob, name in wanted]
+
+        missing = [i for i, r in enumerate(replies) if r is None]
+        calls = []
+        for i in missing:
+            ob, name = wanted[i]
+            key = cls.qualified(name, pk=ob.primary_key)
+            calls.append((ob.primary_key,
+                          partial(cls._standalone_auto[name].request, key)))
+
+        conn = cls._reader(consistent=consistent)
+        # Replicas may lag behind, don't cache what they return
+        cache = cls._cache if conn is cls.__redis__ else None
+        if calls and cls._shards is not None:
+            # One pipeline per shard, in parallel
+            res = [r for r, in cluster.execute(cls.__redis__, calls)]
+        elif calls:
+            with conn.pipeline(transaction=not cls.cluster_layout) as pipe:
+                for _, request in calls:
+                    request(pipe)
+                res = pipe.execute()
+
+        for i, r in zip(missing, res if calls else ()):
+            replies[i] = r
+            if r is not None and cache is not None:
+                ob, name = wanted[i]
+                cache.set((ob.primary_key, name), r, version)
+
+        for (ob, name), reply in zip(wanted, replies):
+            field = cls._standalone_auto[name]
+            field._set_instance(ob, field._wrap(ob, field.parse(reply, cls.encoding)))
 
     def as_dict(self):
         return self.data
         
     def __enter__(self):
         if not self.__context_depth__:
-            pipe = self.get_pipeline()
+            pipe = self._pipeline()
             self.redis = pipe.__enter__()
         self.__context_depth__ += 1
         return self
@@ -454,9 +1654,14 @@ class Model(metaclass=MetaModel):
         # Must be set at the beginning of this method
         self.__context_depth__ -= 1
         if not self.__context_depth__:
-            self.redis.execute()
-            self.redis.__exit__(exc_type, exc_value, traceback)
-            self.redis = self.__redis__
+            try:
+                self.redis.execute()
+            finally:
+                # Later writes mustn't go to a failed pipeline
+                self.redis.__exit__(exc_type, exc_value, traceback)
+                self.redis = self.__redis__
+                # Delayed writes invalidate the cached record as well
+                self._invalidate()
 
     def __repr__(self):
         return ("<{0.__name__}/{0._primary_key}={1!r} instance"
@@ -35,3 +35,452 @@ class commandproxy:
 
     def _get_instance(self, attr):
         return self._cache[attr]
+
+
+class foreignproxy:
+    ''' Placeholder for an instance of a foreign model. Only the primary key
+        is known until some other attribute is accessed, at which point the
+        instance is loaded. Equality and hashing don't require the instance. '''
+
+    __slots__ = ('primary_key', '_model', '_data', '_instance')
+
+    def __init__(self, model, primary_key, data=None):
+        # `data` is passed to the constructor of the model
+        object.__setattr__(self, 'primary_key', primary_key)
+        object.__setattr__(self, '_model', model)
+        object.__setattr__(self, '_data', data)
+        object.__setattr__(self, '_instance', None)
+
+    @property
+    def __class__(self):
+        # Make isinstance() treat it as an instance of the model
+        return self._model
+
+    def loaded(self):
+        return self._instance is not None
+
+    def materialize(self):
+        ''' Load (once) and return the instance of the model '''
+        if self._instance is None:
+            instance = self._model(data=self._data, primary_key=self.primary_key)
+            object.__setattr__(self, '_instance', instance)
+            object.__setattr__(self, '_data', None)
+        return self._instance
+
+    def __getattr__(self, attr):
+        return getattr(self.materialize(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.materialize(), attr, value)
+
+    def __delattr__(self, attr):
+        delattr(self.materialize(), attr)
+
+    def __enter__(self):
+        return self.materialize().__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self.materialize().__exit__(exc_type, exc_value, traceback)
+
+    def __repr__(self):
+        return '<lazy {0.__name__}/{0._primary_key}={1!r} at {2:#x}>'.format(
+                    self._model, self.primary_key, id(self))
+
+    def __eq__(self, other):
+        if isinstance(other, foreignproxy):
+            if other._model is not self._model:
+                return NotImplemented
+        elif type(other) is not self._model:
+            return NotImplemented
+        return self.primary_key == other.primary_key
+
+    def __hash__(self):
+        # Same as for instances of the model
+        return hash((self.primary_key, self._model))
+
+
+def _replacing(method):
+    ''' Make a container proxy method that rewrites the whole container '''
+    def wrapper(self, *a, **ka):
+        return self._replace(method, *a, **ka)
+    wrapper.__name__, wrapper.__doc__ = method.__name__, method.__doc__
+    return wrapper
+
+
+class _containerproxy:
+    ''' Base class of values of auto container fields. Changes are applied
+        locally and sent to Redis as the corresponding commands (through the
+        pipeline of the instance inside `with instance:`), instead of
+        rewriting the whole container.
+
+        If `autosave` of the instance is false, changes only mark the field
+        as changed, see Model.save. '''
+
+    __slots__ = ()
+    # Plain type of the container
+    _base = None
+
+    def _key(self):
+        return self._model.qualified(self._field.name,
+                                     pk=self._model.primary_key)
+
+    def _mark(self):
+        ''' Record the state before the first unsaved change. Return true if
+            changes must be written immediately '''
+        model = self._model
+        if model.autosave:
+            return True
+        model._changes.setdefault(self._field.name, self._base(self))
+        return False
+
+    def _send(self, command, *args):
+        ''' Write a change before it's applied locally '''
+        if self._mark():
+            self._model.redis.execute_command(command, self._key(), *args)
+            self._model._invalidate()
+
+    def _replace(self, method, *a, **ka):
+        ''' Apply `method` locally and write the whole container '''
+        if not self._mark():
+            return method(self, *a, **ka)
+
+        rv = method(self, *a, **ka)
+        key, values = self._key(), self._field.flatten(self)
+        with self._model as model:
+            model.redis.delete(key)
+            if values:
+                model.redis.execute_command(self._field.command, key, *values)
+        return rv
+
+    def clear(self):
+        self._send('DEL')
+        self._base.clear(self)
+
+
+class listproxy(_containerproxy, list):
+
+    __slots__ = ('_model', '_field')
+    _base = list
+
+    def __init__(self, model, field, values=()):
+        list.__init__(self, values)
+        self._model, self._field = model, field
+
+    def append(self, value):
+        self._send('RPUSH', value)
+        list.append(self, value)
+
+    def extend(self, values):
+        values = list(values)
+        if values:
+            self._send('RPUSH', *values)
+        list.extend(self, values)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            return self._replace(list.__setitem__, index, value)
+        index = range(len(self))[index]
+        self._send('LSET', index, value)
+        list.__setitem__(self, index, value)
+
+    def pop(self, index=-1):
+        index = range(len(self))[index]
+        if index == len(self) - 1:
+            self._send('RPOP')
+        elif index == 0:
+            self._send('LPOP')
+        else:
+            return self._replace(list.pop, index)
+        return list.pop(self, index)
+
+    insert = _replacing(list.insert)
+    remove = _replacing(list.remove)
+    reverse = _replacing(list.reverse)
+    sort = _replacing(list.sort)
+    __delitem__ = _replacing(list.__delitem__)
+    __imul__ = _replacing(list.__imul__)
+
+
+class setproxy(_containerproxy, set):
+
+    __slots__ = ('_model', '_field')
+    _base = set
+
+    def __init__(self, model, field, values=()):
+        set.__init__(self, values)
+        self._model, self._field = model, field
+
+    # SADD and SREM are sent even if the local copy says nothing changes,
+    # it may be outdated (changed by another client, read from a replica)
+
+    def add(self, value):
+        self._send('SADD', value)
+        set.add(self, value)
+
+    def discard(self, value):
+        self._send('SREM', value)
+        set.discard(self, value)
+
+    def remove(self, value):
+        if value not in self:
+            raise KeyError(value)
+        self.discard(value)
+
+    def pop(self):
+        if not self:
+            raise KeyError('pop from an empty set')
+        value = next(iter(self))
+        self.discard(value)
+        return value
+
+    def update(self, *others):
+        new = set().union(*others)
+        if new:
+            self._send('SADD', *new)
+            set.update(self, new)
+
+    def difference_update(self, *others):
+        gone = set().union(*others)
+        if gone:
+            self._send('SREM', *gone)
+            set.difference_update(self, gone)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    intersection_update = _replacing(set.intersection_update)
+    symmetric_difference_update = _replacing(set.symmetric_difference_update)
+    __iand__ = _replacing(set.__iand__)
+    __ixor__ = _replacing(set.__ixor__)
+
+
+class hashproxy(_containerproxy, dict):
+
+    __slots__ = ('_model', '_field')
+    _base = dict
+    # Removes members
+    _remove = 'HDEL'
+
+    def __init__(self, model, field, values=()):
+        dict.__init__(self, values)
+        self._model, self._field = model, field
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._send(self._remove, key)
+        dict.__delitem__(self, key)
+
+    def update(self, *a, **ka):
+        new = dict(*a, **ka)
+        if new:
+            self._send(self._field.command, *self._field.flatten(new))
+            dict.update(self, new)
+
+    def pop(self, key, *default):
+        # Sent even if the local copy doesn't have the key, see setproxy
+        self._send(self._remove, key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        if not self:
+            raise KeyError('popitem(): dictionary is empty')
+        # Find the last key (reversed(dict) requires Python 3.8), putting
+        # it back keeps its position
+        key, value = dict.popitem(self)
+        dict.__setitem__(self, key, value)
+        return key, self.pop(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+
+class sortedsetproxy(hashproxy):
+
+    __slots__ = ()
+    _remove = 'ZREM'
+
+
+class _view:
+    ''' Read-only view of a large auto container field. Nothing is loaded
+        until it's needed, and then at most `page_size` elements at a time. '''
+
+    __slots__ = ('key', 'model')
+    page_size = 1000
+
+    def __init__(self, key, model):
+        self.key, self.model = key, model
+
+    @property
+    def redis(self):
+        # Never the pipeline of the instance, a read replica if there are any
+        return self.model._reader(self.model.primary_key)
+
+    def _decode(self, value):
+        if isinstance(value, bytes):
+            return value.decode(self.model.encoding)
+        return value
+
+    # Ordered views define `_range(start, stop)`, which returns
+    # the elements between two inclusive indexes
+
+    def _slice(self, index):
+        indices = range(len(self))[index]
+        if not indices:
+            return []
+        low = min(indices[0], indices[-1])
+        values = self._range(low, max(indices[0], indices[-1]))
+        return [values[i - low] for i in indices]
+
+    def _pages(self):
+        start = 0
+        while True:
+            page = self._range(start, start + self.page_size - 1)
+            yield from page
+            if len(page) < self.page_size:
+                return
+            start += self.page_size
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __repr__(self):
+        return '<{} of {!r} at {:#x}>'.format(type(self).__name__,
+                                               self.key, id(self))
+
+
+class listview(_view):
+
+    __slots__ = ()
+
+    def __len__(self):
+        return self.redis.llen(self.key)
+
+    def _range(self, start, stop):
+        return [self._decode(x) for x in self.redis.lrange(self.key, start, stop)]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._slice(index)
+
+        value = self.redis.lindex(self.key, index)
+        if value is None:
+            raise IndexError('list index out of range')
+        return self._decode(value)
+
+    __iter__ = _view._pages
+
+    def __contains__(self, value):
+        return any(x == value for x in self)
+
+
+class setview(_view):
+
+    __slots__ = ()
+
+    def __len__(self):
+        return self.redis.scard(self.key)
+
+    def __contains__(self, value):
+        return bool(self.redis.sismember(self.key, value))
+
+    def __iter__(self):
+        # May return an element more than once if the set changes
+        for x in self.redis.sscan_iter(self.key, count=self.page_size):
+            yield self._decode(x)
+
+
+class hashview(_view):
+
+    __slots__ = ()
+
+    def __len__(self):
+        return self.redis.hlen(self.key)
+
+    def __contains__(self, key):
+        return bool(self.redis.hexists(self.key, key))
+
+    def __getitem__(self, key):
+        value = self.redis.hget(self.key, key)
+        if value is None:
+            raise KeyError(key)
+        return self._decode(value)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        for k, v in self.redis.hscan_iter(self.key, count=self.page_size):
+            yield self._decode(k), self._decode(v)
+
+    def __iter__(self):
+        for k, _ in self.items():
+            yield k
+
+    keys = __iter__
+
+    def values(self):
+        for _, v in self.items():
+            yield v
+
+
+class sortedsetview(_view):
+    ''' Members are ordered by score, slices return (member, score) pairs '''
+
+    __slots__ = ()
+
+    def __len__(self):
+        return self.redis.zcard(self.key)
+
+    def __contains__(self, member):
+        return self.redis.zscore(self.key, member) is not None
+
+    def __getitem__(self, member):
+        if isinstance(member, slice):
+            return self._slice(member)
+
+        score = self.redis.zscore(self.key, member)
+        if score is None:
+            raise KeyError(member)
+        return score
+
+    def get(self, member, default=None):
+        score = self.redis.zscore(self.key, member)
+        return default if score is None else score
+
+    def _range(self, start, stop):
+        return [(self._decode(m), s) for m, s in
+                self.redis.zrange(self.key, start, stop, withscores=True)]
+
+    items = _view._pages
+
+    def __iter__(self):
+        for member, _ in self.items():
+            yield member
+
+    keys = __iter__
+
+    def values(self):
+        for _, score in self.items():
+            yield score
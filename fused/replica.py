@@ -0,0 +1,151 @@
+''' Routing of read-only requests to read replicas, see Model.redis_read.
+
+    Replicas lag behind the primary, so a record read from a replica right
+    after a write may be outdated. Pass `consistent=True` to the reading
+    method, or read inside `with consistent():`, to read from the primary. '''
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+import redis
+
+try:
+    # Requires Python 3.7
+    from contextvars import ContextVar, copy_context
+except ImportError:
+    ContextVar = copy_context = None
+
+
+class _LocalVar(threading.local):
+    ''' Stand-in for ContextVar on older versions of Python, the value is
+        kept per thread instead of per context '''
+
+    def __init__(self, name, default):
+        self.name, self.value = name, default
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        token, self.value = self.value, value
+        return token
+
+    def reset(self, token):
+        self.value = token
+
+
+# True inside `with consistent():`
+if ContextVar is not None:
+    _consistent = ContextVar('consistent', default=False)
+else:
+    _consistent = _LocalVar('consistent', default=False)
+
+
+@contextmanager
+def consistent():
+    ''' Read from the primaries of all models inside the block '''
+    token = _consistent.set(True)
+    try:
+        yield
+    finally:
+        _consistent.reset(token)
+
+
+def is_consistent():
+    ''' Return true inside `with consistent():` '''
+    return _consistent.get()
+
+
+def bind(function):
+    ''' Return a function that calls `function` in the current context, so
+        that it reads from the primaries in other threads as well if called
+        inside `with consistent():` '''
+    if not isinstance(_consistent, _LocalVar):
+        return partial(copy_context().run, function)
+
+    flag = is_consistent()
+
+    def wrapper(*a, **ka):
+        if not flag:
+            return function(*a, **ka)
+        with consistent():
+            return function(*a, **ka)
+    return wrapper
+
+
+class ReplicaSet:
+    ''' Balances read-only requests between `connections`. With 'round-robin'
+        balancing the replicas take turns, with 'latency' the one with the
+        shortest round-trip time of PING is used. Round-trip times are
+        measured by the first request, then in a background thread every
+        `probe_interval` seconds, so requests don't wait for slow replicas. '''
+
+    def __init__(self, connections, balancing='round-robin', probe_interval=5):
+        if balancing not in {'round-robin', 'latency'}:
+            raise ValueError('balancing must be \'round-robin\' or \'latency\'')
+        self.connections = list(connections)
+        if not self.connections:
+            raise ValueError('No replicas')
+        self.balancing = balancing
+        self.probe_interval = probe_interval
+        self._cycle = itertools.cycle(self.connections)
+        self._lock = threading.Lock()
+        self._latency = [0.0] * len(self.connections)
+        self._probed = None
+        self._probing = False
+
+    def __repr__(self):
+        return '<ReplicaSet of {} replicas ({}) at {:#x}>'.format(
+            len(self.connections), self.balancing, id(self))
+
+    def get(self):
+        ''' Return the connection for the next read-only request, or None
+            if no replica was reachable ('latency' balancing only) '''
+        if self.balancing == 'round-robin':
+            with self._lock:
+                return next(self._cycle)
+
+        with self._lock:
+            if self._probed is None:
+                # Concurrent first requests wait for the same measurement
+                self._update(self._measure())
+            elif (not self._probing and
+                  time.monotonic() - self._probed >= self.probe_interval):
+                self._probing = True
+                threading.Thread(target=self.probe, daemon=True).start()
+            latency = self._latency
+
+        best = min(range(len(self.connections)), key=latency.__getitem__)
+        if latency[best] == float('inf'):
+            return None
+        return self.connections[best]
+
+    def latency(self):
+        ''' Return the last measured round-trip times in seconds
+            (inf for unreachable replicas) '''
+        return list(self._latency)
+
+    def probe(self):
+        ''' Measure the round-trip time of every replica '''
+        latency = self._measure()
+        with self._lock:
+            self._update(latency)
+
+    def _measure(self):
+        latency = []
+        for connection in self.connections:
+            start = time.monotonic()
+            try:
+                connection.ping()
+            except redis.RedisError:
+                latency.append(float('inf'))
+            else:
+                latency.append(time.monotonic() - start)
+        return latency
+
+    def _update(self, latency):
+        # Called with the lock held
+        self._latency = latency
+        self._probed = time.monotonic()
+        self._probing = False
@@ -0,0 +1,51 @@
+-- Completely delete records: their hashes, standalone keys, entries in
+-- unique indexes, other indexes and _records.
+--
+-- KEYS: _records, unique index hashes...
+-- ARGV: prefix of record keys, field separator, number of unique fields,
+--       number of standalone fields, number of indexes,
+--       names of unique fields..., names of standalone fields...,
+--       for each index: field name, type, key or key prefix,
+--       primary keys...
+--
+-- Returns the number of records that existed.
+--
+-- Record hashes, standalone keys and index sets are built from ARGV, so the
+-- script works on a single Redis instance (or one shard, see fused.shard)
+-- only. The cluster layout deletes records separately (see fused.cluster).
+local PREFIX, SEP = ARGV[1], ARGV[2];
+local NU, NS, NI = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5]);
+local FIRST_INDEX = 6 + NU + NS;
+local deleted = 0;
+
+for i=FIRST_INDEX + 3 * NI, #ARGV do
+    local id = ARGV[i];
+    local record = PREFIX .. id;
+
+    for j=1, NU do
+        local value = redis.call('HGET', record, ARGV[j + 5]);
+        if value and redis.call('HGET', KEYS[j + 1], value) == id then
+            redis.call('HDEL', KEYS[j + 1], value);
+        end
+    end
+
+    for j=FIRST_INDEX, FIRST_INDEX + 3 * NI - 1, 3 do
+        if ARGV[j + 1] == 'range' then
+            redis.call('ZREM', ARGV[j + 2], id);
+        else
+            local value = redis.call('HGET', record, ARGV[j]);
+            if value then
+                redis.call('SREM', ARGV[j + 2] .. value, id);
+            end
+        end
+    end
+
+    for j=1, NS do
+        redis.call('DEL', record .. SEP .. ARGV[j + 5 + NU]);
+    end
+
+    redis.call('DEL', record);
+    deleted = deleted + redis.call('ZREM', KEYS[1], id);
+end
+
+return deleted
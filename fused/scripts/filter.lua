@@ -0,0 +1,33 @@
+-- Find records matching all conditions on indexed fields
+-- KEYS: index sets, grouped by condition
+-- ARGV: number of sets for each condition, a record matches a condition
+--       if it's in any of its sets
+-- Returns the primary keys of matching records
+local result, pos = nil, 1;
+
+for _, count in ipairs(ARGV) do
+    count = tonumber(count);
+    local members = redis.call('SUNION', unpack(KEYS, pos, pos + count - 1));
+    pos = pos + count;
+
+    if result == nil then
+        result = members;
+    else
+        local found, kept = {}, {};
+        for _, pk in ipairs(members) do
+            found[pk] = true;
+        end
+        for _, pk in ipairs(result) do
+            if found[pk] then
+                kept[#kept + 1] = pk;
+            end
+        end
+        result = kept;
+    end
+
+    if #result == 0 then
+        break
+    end
+end
+
+return result
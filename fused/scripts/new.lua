@@ -0,0 +1,71 @@
+-- Create a new record: reserve the primary key, claim the unique values,
+-- write the main hash, add the record to indexes and write all standalone
+-- keys.
+--
+-- KEYS: _records, main hash, unique index hashes..., indexes...,
+--       standalone keys...
+-- ARGV: score, primary key, number of unique fields, number of hash fields,
+--       number of indexes, unique values..., hash field/value pairs...,
+--       then for each index and standalone key: command, number of
+--       arguments, arguments...
+--
+-- Returns 0 for success, -1 if the primary key is taken, and the position
+-- of the first duplicate unique field otherwise. Invalid scores are
+-- reported as errors, before anything is written.
+local SCORE, ID = ARGV[1], ARGV[2];
+local NU, NH, NI = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5]);
+
+-- Don't hit Lua's stack limit on huge containers
+local function variadic(command, key, first, last)
+    for i=first, last, 1000 do
+        redis.call(command, key, unpack(ARGV, i, math.min(i + 999, last)));
+    end
+end
+
+-- ZADD fails on scores that aren't numbers (or NaN), check them first
+local scores, pos = {SCORE}, 6 + NU + 2 * NH;
+for i=1, NI do
+    local command, count = ARGV[pos], tonumber(ARGV[pos + 1]);
+    if command == 'ZADD' then
+        scores[#scores + 1] = ARGV[pos + 2];
+    end
+    pos = pos + 2 + count;
+end
+for _, score in ipairs(scores) do
+    local n = tonumber(score);
+    if not n or n ~= n then
+        return redis.error_reply('ERR invalid score ' .. score);
+    end
+end
+
+if redis.call('ZSCORE', KEYS[1], ID) then
+    return -1
+end
+
+for i=1, NU do
+    if redis.call('HEXISTS', KEYS[i + 2], ARGV[i + 5]) ~= 0 then
+        return i
+    end
+end
+
+redis.call('ZADD', KEYS[1], SCORE, ID);
+
+for i=1, NU do
+    redis.call('HSET', KEYS[i + 2], ARGV[i + 5], ID);
+end
+
+pos = 6 + NU;
+variadic('HMSET', KEYS[2], pos, pos + 2 * NH - 1);
+pos = pos + 2 * NH;
+
+for i=3 + NU, #KEYS do
+    local command, count = ARGV[pos], tonumber(ARGV[pos + 1]);
+    -- Indexes are shared by all records
+    if i > 2 + NU + NI then
+        redis.call('DEL', KEYS[i]);
+    end
+    variadic(command, KEYS[i], pos + 2, pos + 1 + count);
+    pos = pos + 2 + count;
+end
+
+return 0
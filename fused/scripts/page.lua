@@ -0,0 +1,58 @@
+-- Keyset pagination over a sorted set
+-- KEYS[1]: the sorted set
+-- ARGV: limit, '1' for descending order or '0' otherwise, then optionally
+--       the score and the member of the last element of the previous page
+-- Returns up to `limit` members following that element, with scores
+local KEY, LIMIT, REVERSE = KEYS[1], tonumber(ARGV[1]), ARGV[2] == '1';
+local SCORE, MEMBER = ARGV[3], ARGV[4];
+
+if not SCORE then
+    if REVERSE then
+        return redis.call('ZREVRANGE', KEY, 0, LIMIT - 1, 'WITHSCORES')
+    end
+    return redis.call('ZRANGE', KEY, 0, LIMIT - 1, 'WITHSCORES')
+end
+
+-- Fast path: the last element is still there and has the same score
+local current = redis.call('ZSCORE', KEY, MEMBER);
+if current and tonumber(current) == tonumber(SCORE) then
+    if REVERSE then
+        local rank = redis.call('ZREVRANK', KEY, MEMBER);
+        return redis.call('ZREVRANGE', KEY, rank + 1, rank + LIMIT, 'WITHSCORES')
+    end
+    local rank = redis.call('ZRANK', KEY, MEMBER);
+    return redis.call('ZRANGE', KEY, rank + 1, rank + LIMIT, 'WITHSCORES')
+end
+
+-- Otherwise skip the elements with the same score
+-- that precede the last element
+local rv, offset = {}, 0;
+while true do
+    local batch;
+    if REVERSE then
+        batch = redis.call('ZREVRANGEBYSCORE', KEY, SCORE, '-inf',
+                           'WITHSCORES', 'LIMIT', offset, LIMIT);
+    else
+        batch = redis.call('ZRANGEBYSCORE', KEY, SCORE, '+inf',
+                           'WITHSCORES', 'LIMIT', offset, LIMIT);
+    end
+
+    if #batch == 0 then
+        return rv
+    end
+
+    for i=1, #batch, 2 do
+        local member, score = batch[i], batch[i + 1];
+        local tie = tonumber(score) == tonumber(SCORE);
+        if not (tie and ((REVERSE and member >= MEMBER) or
+                         (not REVERSE and member <= MEMBER))) then
+            rv[#rv + 1] = member;
+            rv[#rv + 1] = score;
+            if #rv == 2 * LIMIT then
+                return rv
+            end
+        end
+    end
+
+    offset = offset + LIMIT;
+end
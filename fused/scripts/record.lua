@@ -0,0 +1,27 @@
+-- Write the main hash and the standalone keys of a new record (the part of
+-- the 'new' script that touches the keys of the record).
+--
+-- KEYS: main hash, standalone keys...
+-- ARGV: number of hash fields, hash field/value pairs...,
+--       then for each standalone key: command, number of arguments,
+--       arguments...
+local NH = tonumber(ARGV[1]);
+
+-- Don't hit Lua's stack limit on huge containers
+local function variadic(command, key, first, last)
+    for i=first, last, 1000 do
+        redis.call(command, key, unpack(ARGV, i, math.min(i + 999, last)));
+    end
+end
+
+variadic('HMSET', KEYS[1], 2, 1 + 2 * NH);
+
+local pos = 2 + 2 * NH;
+for i=2, #KEYS do
+    local command, count = ARGV[pos], tonumber(ARGV[pos + 1]);
+    redis.call('DEL', KEYS[i]);
+    variadic(command, KEYS[i], pos + 2, pos + 1 + count);
+    pos = pos + 2 + count;
+end
+
+return 0
@@ -0,0 +1,91 @@
+-- Update the unique indexes, other indexes and _records for records whose
+-- hashes are written separately (the cluster layout, where records and
+-- indexes are in different hash slots).
+--
+-- KEYS: _records, unique index hashes (of all unique fields)...
+-- ARGV: number of unique fields, number of indexes,
+--       for each index: field name, type, key or key prefix,
+--       then for each record: primary key, 1 to remove it from _records
+--       (0 otherwise), and for each unique field and each index: number of
+--       old values, old values..., number of new values (0 or 1), new value
+--
+-- Old values are only removed from the indexes if they point to the record.
+--
+-- Returns {0, number of records removed from _records} for success and
+-- {position of the first unique field whose new value belongs to another
+-- record, 0} otherwise.
+local NU, NI = tonumber(ARGV[1]), tonumber(ARGV[2]);
+
+local indexes, pos = {}, 3;
+for i=1, NI do
+    indexes[i] = {ARGV[pos + 1], ARGV[pos + 2]};
+    pos = pos + 3;
+end
+
+local records = {};
+while pos <= #ARGV do
+    local record = {id = ARGV[pos], remove = ARGV[pos + 1] == '1', fields = {}};
+    pos = pos + 2;
+    for i=1, NU + NI do
+        local nold = tonumber(ARGV[pos]);
+        local old = {unpack(ARGV, pos + 1, pos + nold)};
+        pos = pos + nold + 1;
+        local nnew = tonumber(ARGV[pos]);
+        record.fields[i] = {old, nnew > 0 and ARGV[pos + 1]};
+        pos = pos + nnew + 1;
+    end
+    records[#records + 1] = record;
+end
+
+for _, record in ipairs(records) do
+    for i=1, NU do
+        local new = record.fields[i][2];
+        if new then
+            local owner = redis.call('HGET', KEYS[i + 1], new);
+            if owner and owner ~= record.id then
+                return {i, 0}
+            end
+        end
+    end
+end
+
+local removed = 0;
+for _, record in ipairs(records) do
+    local ID = record.id;
+    for i=1, NU do
+        local old, new = unpack(record.fields[i]);
+        for _, value in ipairs(old) do
+            if value ~= new and redis.call('HGET', KEYS[i + 1], value) == ID then
+                redis.call('HDEL', KEYS[i + 1], value);
+            end
+        end
+        if new then
+            redis.call('HSET', KEYS[i + 1], new, ID);
+        end
+    end
+
+    for i=1, NI do
+        local kind, key = unpack(indexes[i]);
+        local old, new = unpack(record.fields[NU + i]);
+        if kind == 'set' then
+            for _, value in ipairs(old) do
+                if value ~= new then
+                    redis.call('SREM', key .. value, ID);
+                end
+            end
+            if new then
+                redis.call('SADD', key .. new, ID);
+            end
+        elseif new then
+            redis.call('ZADD', key, new, ID);
+        elseif #old > 0 then
+            redis.call('ZREM', key, ID);
+        end
+    end
+
+    if record.remove then
+        removed = removed + redis.call('ZREM', KEYS[1], ID);
+    end
+end
+
+return {0, removed}
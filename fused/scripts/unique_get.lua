@@ -0,0 +1,20 @@
+-- Resolve values of a unique field to primary keys and fetch the records
+-- KEYS[1]: index hash of the unique field
+-- ARGV[1]: prefix of record keys, the rest are the values to look up
+-- Returns the flattened HGETALL reply (empty if not found) for each value
+--
+-- Record keys are built from the primary keys found in the index, so they
+-- can't be declared in KEYS: the script works on a single Redis instance
+-- only. The cluster layout reads records separately (see fused.cluster).
+local rv = {};
+
+for i=2, #ARGV do
+    local pk = redis.call('HGET', KEYS[1], ARGV[i]);
+    if pk then
+        rv[i - 1] = redis.call('HGETALL', ARGV[1] .. pk);
+    else
+        rv[i - 1] = {};
+    end
+end
+
+return rv
@@ -0,0 +1,84 @@
+-- Change fields of an existing record: claim the new values of unique
+-- fields, release their old values, write the record hash and move the
+-- record between indexes.
+--
+-- KEYS: main hash, unique index hashes...
+-- ARGV: primary key, number of unique fields, number of indexes,
+--       number of hash fields to delete,
+--       for each unique field: name, value known to the client, new value,
+--       for each index: field name, type, key or key prefix,
+--       hash fields to delete..., hash field/value pairs...
+--
+-- The old value of a unique field is both the one in the record hash and the
+-- one the client knows about (they differ if the hash is written later, in a
+-- pipeline). Index entries are only removed if they point to this record.
+--
+-- Returns 0 for success and the position of the first unique field whose
+-- new value belongs to another record otherwise.
+--
+-- Index keys are built from ARGV, so the script works on a single Redis
+-- instance (or one shard, see fused.shard) only. The cluster layout uses
+-- the 'reindex' script instead.
+local ID, NU = ARGV[1], tonumber(ARGV[2]);
+local NI, ND = tonumber(ARGV[3]), tonumber(ARGV[4]);
+
+-- Add the record to (or remove it from) the index
+-- of a field for the given value
+local function index(kind, key, value, add)
+    if kind == 'set' then
+        redis.call(add and 'SADD' or 'SREM', key .. value, ID);
+    elseif add then
+        redis.call('ZADD', key, value, ID);
+    else
+        redis.call('ZREM', key, ID);
+    end
+end
+
+for i=1, NU do
+    local owner = redis.call('HGET', KEYS[i + 1], ARGV[3 * i + 4]);
+    if owner and owner ~= ID then
+        return i
+    end
+end
+
+for i=1, NU do
+    local unique, new = KEYS[i + 1], ARGV[3 * i + 4];
+    local stored = redis.call('HGET', KEYS[1], ARGV[3 * i + 2]);
+    for _, old in ipairs({stored or new, ARGV[3 * i + 3]}) do
+        if old ~= new and redis.call('HGET', unique, old) == ID then
+            redis.call('HDEL', unique, old);
+        end
+    end
+    redis.call('HSET', unique, new, ID);
+end
+
+local indexes, first = {}, 5 + 3 * NU;
+for i=first, first + 3 * NI - 1, 3 do
+    local old = redis.call('HGET', KEYS[1], ARGV[i]);
+    indexes[#indexes + 1] = {ARGV[i], ARGV[i + 1], ARGV[i + 2], old};
+end
+
+first = first + 3 * NI;
+if ND > 0 then
+    redis.call('HDEL', KEYS[1], unpack(ARGV, first, first + ND - 1));
+end
+
+first = first + ND;
+for i=first, #ARGV, 1000 do
+    redis.call('HMSET', KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)));
+end
+
+for _, entry in ipairs(indexes) do
+    local name, kind, key, old = unpack(entry);
+    local new = redis.call('HGET', KEYS[1], name);
+    if new ~= old then
+        if old then
+            index(kind, key, old, false);
+        end
+        if new then
+            index(kind, key, new, true);
+        end
+    end
+end
+
+return 0
@@ -0,0 +1,68 @@
+''' Client-side sharding of records across independent Redis servers.
+
+    Set `redis` of a model to a ShardMap to store every record, with its
+    entries in _records and the indexes, on the server its primary key maps
+    to. Requests for one record go to its server, requests for many records
+    are sent to all servers involved in parallel and their results merged. '''
+import hashlib
+from bisect import bisect
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _hash(value):
+    if not isinstance(value, bytes):
+        value = str(value).encode('utf-8')
+    return int.from_bytes(hashlib.md5(value).digest()[:8], 'big')
+
+
+class ShardMap:
+    ''' Consistent hash ring over primary keys. `shards` is a mapping of
+        names to connections or a list of connections (named by position).
+        Every shard gets `replicas` points on the ring, so adding a shard
+        only moves the records that map to it. '''
+
+    def __init__(self, shards, replicas=128):
+        if not isinstance(shards, Mapping):
+            shards = {str(i): x for i, x in enumerate(shards)}
+        if not shards:
+            raise ValueError('No shards')
+        self.shards = dict(shards)
+        ring = sorted((_hash('{}:{}'.format(name, i)), name)
+                      for name in self.shards for i in range(replicas))
+        self._points = [point for point, _ in ring]
+        self._names = [name for _, name in ring]
+
+    def __repr__(self):
+        return '<ShardMap of {} shards at {:#x}>'.format(len(self.shards), id(self))
+
+    def __len__(self):
+        return len(self.shards)
+
+    def connections(self):
+        return list(self.shards.values())
+
+    def get(self, pk):
+        ''' Return the connection to the shard `pk` maps to '''
+        i = bisect(self._points, _hash(pk)) % len(self._points)
+        return self.shards[self._names[i]]
+
+    def group(self, pks):
+        ''' Return a dictionary mapping connections to lists
+            of primary keys from `pks` that map to them '''
+        rv = {}
+        for pk in pks:
+            rv.setdefault(self.get(pk), []).append(pk)
+        return rv
+
+    def map(self, function, connections=None):
+        ''' Call `function` with every connection (of `connections`, all
+            shards by default) in parallel. Return the list of results '''
+        if connections is None:
+            connections = self.connections()
+        else:
+            connections = list(connections)
+        if len(connections) < 2:
+            return [function(x) for x in connections]
+        with ThreadPoolExecutor(max_workers=len(connections)) as executor:
+            return list(executor.map(function, connections))
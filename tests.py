@@ -1,16 +1,28 @@
+import asyncio
 import redis
-from fused import fields, model, exceptions, proxies
+import time
+from fused import fields, model, exceptions, proxies, codec, cluster, shard, replica, cache
 import pytest
 
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+else:
+    from fused import aio
+
 
 TEST_PORT = 6379
 TEST_DB = 14
 TEST_CONNECTION = redis.Redis(port=TEST_PORT, db=TEST_DB)
+# The second shard of sharded models, the "replica" of replicatedmodel
+TEST_SHARD = redis.Redis(port=TEST_PORT, db=TEST_DB + 1)
 
 
 @pytest.fixture(autouse=True)
 def flushdb():
     TEST_CONNECTION.flushdb()
+    TEST_SHARD.flushdb()
 
 
 class lightmodel(model.Model):
@@ -31,6 +43,15 @@ class automodel(model.Model):
     hash = fields.Hash(auto=True)
 
 
+class lazyautomodel(model.Model):
+    redis = TEST_CONNECTION
+    id = fields.PrimaryKey()
+    list = fields.List(auto=True, lazy=True)
+    set = fields.Set(auto=True, lazy=True)
+    hash = fields.Hash(auto=True, lazy=True)
+    sortedset = fields.SortedSet(auto=True, lazy=True)
+
+
 class fulltestmodel(model.Model):
     redis = TEST_CONNECTION
     id = fields.PrimaryKey()
@@ -57,6 +78,29 @@ class nodecodetestmodel(model.Model):
     plain_set = fields.Set()
 
 
+
+class containermodel(model.Model):
+    redis = TEST_CONNECTION
+    id = fields.PrimaryKey()
+    list = fields.List()
+    set = fields.Set()
+    hash = fields.Hash()
+    sortedset = fields.SortedSet()
+    literal = fields.List(codec=codec.Literal())
+
+
+class uniquelistmodel(model.Model):
+    redis = TEST_CONNECTION
+    id = fields.PrimaryKey()
+    list = fields.List(unique=True)
+
+
+class literalmodel(model.Model):
+    redis = TEST_CONNECTION
+    codec = codec.Literal()
+    id = fields.PrimaryKey()
+    list = fields.List()
+
 # Pair of models to test circular foreign relations
 
 class foreign_a(model.Model):
@@ -77,6 +121,86 @@ class self_foreign(model.Model):
     field = fields.Foreign('self_foreign')
 
 
+class lazymodel(model.Model):
+    redis = TEST_CONNECTION
+    id = fields.PrimaryKey()
+    field = fields.Foreign(lightmodel, lazy=True)
+
+
+
+class cachedmodel(model.Model):
+    redis = TEST_CONNECTION
+    cache_size = 2
+    id = fields.PrimaryKey()
+    unique = fields.String(unique=True)
+    str = fields.String()
+
+
+
+class trackedmodel(model.Model):
+    redis = TEST_CONNECTION
+    cache_size = 10
+    cache_invalidation = 'tracking'
+    id = fields.PrimaryKey()
+    str = fields.String()
+    set = fields.Set(auto=True)
+
+
+class keyspacemodel(model.Model):
+    redis = TEST_CONNECTION
+    cache_size = 10
+    cache_invalidation = 'keyspace'
+    id = fields.PrimaryKey()
+    str = fields.String()
+    set = fields.Set(auto=True)
+
+
+class indexedmodel(model.Model):
+    redis = TEST_CONNECTION
+    id = fields.PrimaryKey()
+    status = fields.String(index=True)
+    kind = fields.String(index=True)
+    name = fields.String()
+    price = fields.Integer(index='range')
+
+
+class clustermodel(model.Model):
+    redis = TEST_CONNECTION
+    cluster_layout = True
+    id = fields.PrimaryKey()
+    unique = fields.String(unique=True)
+    status = fields.String(index=True)
+    price = fields.Integer(index='range')
+    set = fields.Set(auto=True)
+    proxy = fields.Set(standalone=True)
+
+
+class shardedmodel(model.Model):
+    redis = shard.ShardMap([TEST_CONNECTION, TEST_SHARD])
+    id = fields.PrimaryKey()
+    status = fields.String(index=True)
+    price = fields.Integer(index='range')
+    list = fields.List(auto=True)
+    proxy = fields.Set(standalone=True)
+
+
+class replicatedmodel(model.Model):
+    redis = TEST_CONNECTION
+    # Never gets the writes, which tells where the reads go
+    redis_read = [TEST_SHARD]
+    id = fields.PrimaryKey()
+    unique = fields.String(unique=True)
+    status = fields.String(index=True)
+    list = fields.List(auto=True)
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
 # BUG: can use any commands, regardless of the field type
 # @pytest.mark.parametrize('command,args,inverse,invargs', [
 #     ('HSET', (b'<string>', 1), 'HKEYS', ()),
@@ -131,6 +255,38 @@ class TestModelUpdate:
         with pytest.raises(exceptions.DuplicateEntry):
             new.unique = other.unique
 
+    def test_set_unique_index(self):
+        index = fulltestmodel.qualified('unique')
+        new = fulltestmodel.new(id='A', unique='<string 1>', required='')
+        new.unique = '<string 2>'
+        # Assigning the current value is fine
+        new.unique = '<string 2>'
+        assert TEST_CONNECTION.hgetall(index) == {b'<string 2>': b'A'}
+        # Doesn't raise
+        fulltestmodel.new(id='B', unique='<string 1>', required='')
+
+        with new:
+            new.unique = '<string 3>'
+            new.unique = '<string 4>'
+        new.autosave = False
+        new.unique = '<string 5>'
+        new.save()
+        assert TEST_CONNECTION.hgetall(index) == {b'<string 1>': b'B',
+                                                  b'<string 5>': b'A'}
+        assert fulltestmodel(unique='<string 5>') == new
+
+    def test_set_unique_container(self):
+        index = uniquelistmodel.qualified('list')
+        new = uniquelistmodel.new(id='A', list=['y'])
+        new.list = ['z']
+        assert TEST_CONNECTION.hgetall(index) == {b'J["z"]': b'A'}
+        assert uniquelistmodel(list=['z']) == new
+        assert [x.primary_key for x in uniquelistmodel.get(list=[['z'], ['y']])] == ['A']
+        with pytest.raises(exceptions.DuplicateEntry):
+            uniquelistmodel.new(id='B', list=['z'])
+        del new.list
+        assert TEST_CONNECTION.hgetall(index) == {}
+
     def test_delete_unique(self):
         ka = {'id': 'A', 'unique': '<string>', 'required': ''}
         new = fulltestmodel.new(**ka)
@@ -181,6 +337,124 @@ class TestModelUpdate:
         delattr(tm, field)
         assert getattr(tm, field) == type(value)()
 
+    def test_mutate_auto(self):
+        tm = automodel.new(id='A', list=['1', '2'], set={'a'},
+                           hash={'a': 'b'}, sortedset={'a': 1})
+        TEST_CONNECTION.config_resetstat()
+        tm.list.append('3')
+        tm.list += ['4', '5']
+        tm.list[0] = '0'
+        assert tm.list.pop() == '5'
+        assert tm.list.pop(0) == '0'
+        tm.set.add('b')
+        tm.set.discard('a')
+        tm.set |= {'c'}
+        tm.hash['c'] = 'd'
+        del tm.hash['a']
+        tm.sortedset.update(b=2)
+        assert tm.sortedset.pop('a') == 1
+        stats = TEST_CONNECTION.info('commandstats')
+        assert 'cmdstat_del' not in stats
+        assert stats['cmdstat_rpush']['calls'] == 2
+
+        loaded = automodel(id='A')
+        assert loaded.list == tm.list == ['2', '3', '4']
+        assert loaded.set == tm.set == {'b', 'c'}
+        assert loaded.hash == tm.hash == {'c': 'd'}
+        assert loaded.sortedset == tm.sortedset == {'b': 2}
+
+        # Changes that rewrite the whole container
+        tm.list.insert(0, '1')
+        tm.list.sort(reverse=True)
+        tm.set &= {'c'}
+        loaded = automodel(id='A')
+        assert loaded.list == ['4', '3', '2', '1']
+        assert loaded.set == {'c'}
+
+    def test_mutate_auto_stale(self):
+        tm = automodel.new(id='A', set={'a'}, hash={'a': 'b', 'c': 'd'})
+        tm.set, tm.hash
+        # Changed by another client, the local copies are outdated
+        other = automodel(id='A')
+        other.set.discard('a')
+        other.set.add('b')
+        other.hash['e'] = 'f'
+        tm.set.add('a')
+        tm.set -= {'b'}
+        tm.hash.pop('e', None)
+        assert automodel(id='A').set == {'a'}
+        assert automodel(id='A').hash == {'a': 'b', 'c': 'd'}
+        assert tm.hash.popitem() == ('c', 'd')
+        assert automodel(id='A').hash == {'a': 'b'}
+
+    def test_mutate_auto_delayed(self):
+        tm = automodel.new(id='A', list=['1'])
+        with tm:
+            tm.list.append('2')
+            tm.list.extend(['3'])
+            assert automodel(id='A').list == ['1']
+        assert automodel(id='A').list == ['1', '2', '3']
+
+        tm.autosave = False
+        tm.list.append('4')
+        assert tm.dirty() == {'list'}
+        tm.discard()
+        assert tm.list == ['1', '2', '3']
+        tm.list.append('4')
+        tm.save()
+        assert automodel(id='A').list == ['1', '2', '3', '4']
+
+    def test_lazy_auto(self, monkeypatch):
+        monkeypatch.setattr(proxies._view, 'page_size', 3)
+        items = [str(i) for i in range(10)]
+        tm = lazyautomodel.new(id='A', list=items, set=set(items),
+                               hash={x: x + x for x in items},
+                               sortedset={x: int(x) for x in items})
+        TEST_CONNECTION.config_resetstat()
+        assert len(tm.list) == len(tm.set) == len(tm.hash) == len(tm.sortedset) == 10
+        assert tm.list[3] == '3' and tm.list[-1] == '9'
+        assert tm.list[2:8:2] == ['2', '4', '6']
+        assert tm.list[::-3] == ['9', '6', '3', '0']
+        assert list(tm.list) == items
+        assert '5' in tm.list and 'x' not in tm.list
+        assert '5' in tm.set and 'x' not in tm.set
+        assert sorted(tm.set) == items
+        assert tm.hash['5'] == '55' and tm.hash.get('x') is None
+        assert '5' in tm.hash and 'x' not in tm.hash
+        assert dict(tm.hash.items()) == {x: x + x for x in items}
+        assert tm.sortedset['5'] == 5 and '5' in tm.sortedset
+        assert tm.sortedset[-2:] == [('8', 8), ('9', 9)]
+        assert list(tm.sortedset) == items
+        with pytest.raises(IndexError):
+            tm.list[10]
+        with pytest.raises(KeyError):
+            tm.hash['x']
+        stats = TEST_CONNECTION.info('commandstats')
+        for command in ('smembers', 'hgetall'):
+            assert 'cmdstat_' + command not in stats
+
+        tm.list = ['a']
+        assert list(tm.list) == ['a']
+        tm.autosave = False
+        tm.set = {'b'}
+        assert tm.set == {'b'}
+        tm.save()
+        assert list(tm.set) == ['b']
+
+        # Lazy fields stay views
+        tm.load()
+        assert isinstance(tm.list, proxies._view)
+        with pytest.raises(ValueError):
+            tm.load('list')
+        with pytest.raises(ValueError):
+            list(lazyautomodel.get(pks=['A'], with_fields=['set']))
+
+        with pytest.raises(exceptions.FusedError):
+            class badmodel(model.Model):
+                redis = TEST_CONNECTION
+                id = fields.PrimaryKey()
+                str = fields.String(auto=True, lazy=True)
+
     # Delayed updates
     def test_cm_updates(self):
         ka = {'id': 'A', 'unique': '<string>', 'required': ''}
@@ -204,6 +478,96 @@ class TestModelUpdate:
         assert loaded.auto_set == upd['auto_set']
         assert loaded.proxy_set.smembers() == upd['proxy_set']
 
+    # Unit of work
+    def test_save(self):
+        new = fulltestmodel.new(id='A', unique='<string>', required='')
+        new.autosave = False
+        TEST_CONNECTION.config_resetstat()
+        new.required = 'value'
+        new.unique = '<other string>'
+        new.auto_set = {'a', 'b'}
+        assert new.required == 'value'
+        assert new.auto_set == {'a', 'b'}
+        assert new.dirty() == {'required', 'unique', 'auto_set'}
+        assert 'cmdstat_hmset' not in TEST_CONNECTION.info('commandstats')
+        assert fulltestmodel(id='A').required == ''
+
+        new.save()
+        assert not new.dirty()
+        loaded = fulltestmodel(id='A')
+        assert loaded.required == 'value'
+        assert loaded.unique == '<other string>'
+        assert loaded.auto_set == {'a', 'b'}
+
+    def test_save_duplicate(self):
+        fulltestmodel.new(id='A', unique='<string 1>', required='')
+        new = fulltestmodel.new(id='B', unique='<string 2>', required='')
+        new.autosave = False
+        new.unique = '<string 1>'
+        new.required = 'value'
+        with pytest.raises(exceptions.DuplicateEntry):
+            new.save()
+        assert new.dirty() == {'unique', 'required'}
+        assert fulltestmodel(id='B').required == ''
+
+        new.unique = '<string 3>'
+        new.save()
+        assert fulltestmodel(unique='<string 3>') == new
+
+    def test_save_failure(self, monkeypatch):
+        new = fulltestmodel.new(id='A', unique='<string>', required='')
+        new.autosave = False
+        new.unique = '<other string>'
+        new.auto_set = {'a'}
+
+        def fail(key, connection, value):
+            raise redis.RedisError
+        monkeypatch.setattr(fields.Set, 'save', staticmethod(fail))
+        with pytest.raises(redis.RedisError):
+            new.save()
+        # The unique field was written by the script, the rest is unsaved
+        assert fulltestmodel(unique='<other string>') == new
+        assert new.dirty() == {'auto_set'}
+
+        monkeypatch.undo()
+        new.save()
+        assert fulltestmodel(id='A').auto_set == {'a'}
+
+        # Emptied containers are deleted
+        new.auto_set = set()
+        new.save()
+        assert fulltestmodel(id='A').auto_set == set()
+
+    def test_failed_transaction(self, monkeypatch):
+        new = fulltestmodel.new(id='A', unique='<string>', required='')
+        new.autosave = False
+        new.auto_set = {'a'}
+
+        def invalid(key, connection, value):
+            connection.execute_command('SADD', key)
+        monkeypatch.setattr(fields.Set, 'save', staticmethod(invalid))
+        with pytest.raises(redis.ResponseError):
+            new.save()
+        # The instance doesn't keep the failed pipeline
+        new.autosave = True
+        new.required = 'x'
+        assert fulltestmodel(id='A').required == 'x'
+
+    def test_discard(self):
+        new = fulltestmodel.new(id='A', unique='<string>', required='')
+        new.autosave = False
+        new.required = 'value'
+        new.required = 'other value'
+        new.plain_set = {1}
+        new.auto_set = {'a'}
+        new.discard()
+        assert not new.dirty()
+        assert new.required == ''
+        assert new.plain_set is None
+        assert new.auto_set == set()
+        new.save()
+        assert fulltestmodel(id='A').required == ''
+
 
 class TestModelNew:
 
@@ -223,8 +587,89 @@ class TestModelNew:
 
     def test_pk_uniqueness(self):
         new = lightmodel.new(id='A')
-        with pytest.raises(exceptions.DuplicateEntry):
+        with pytest.raises(exceptions.DuplicateEntry) as e:
             lightmodel.new(id='A')
+        assert e.value.args == ('id', 'A')
+
+    def test_no_partial_records(self):
+        ka = {'id': 'A', 'unique': '<string>', 'required': '',
+              'auto_set': {'1', '2'}}
+        fulltestmodel.new(**ka)
+        dup = dict(ka, id='B', required='<other>')
+        with pytest.raises(exceptions.DuplicateEntry) as e:
+            fulltestmodel.new(**dup)
+        assert e.value.args == ('unique', '<string>')
+        assert fulltestmodel.count() == 1
+        assert not TEST_CONNECTION.exists(fulltestmodel.qualified(pk='B'))
+        assert not TEST_CONNECTION.exists(fulltestmodel.qualified('auto_set', pk='B'))
+        # The primary key wasn't reserved
+        fulltestmodel.new(**dict(dup, unique='<other string>'))
+        # The existing record is left untouched
+        with pytest.raises(exceptions.DuplicateEntry):
+            fulltestmodel.new(**dict(ka, unique='<third string>', required='X'))
+        assert fulltestmodel(id='A').required == ''
+
+    def test_new_many(self):
+        records = [{'id': str(i), 'unique': 'u' + str(i), 'required': ''}
+                   for i in range(10)]
+        records[3]['unique'] = 'u1'
+        records[5]['id'] = '0'
+        del records[7]['required']
+        res = list(fulltestmodel.new_many(records, batch_size=4))
+        assert len(res) == 10
+        assert isinstance(res[3], exceptions.DuplicateEntry)
+        assert res[3].args == ('unique', 'u1')
+        assert isinstance(res[5], exceptions.DuplicateEntry)
+        assert res[5].args == ('id', '0')
+        assert isinstance(res[7], exceptions.MissingFields)
+        created = [x for x in res if isinstance(x, fulltestmodel)]
+        assert [x.primary_key for x in created] == ['0', '1', '2', '4', '6', '8', '9']
+        assert fulltestmodel.count() == 7
+        assert fulltestmodel(unique='u9').primary_key == '9'
+
+    def test_new_many_scores(self):
+        res = list(lightmodel.new_many([{'id': (1, 'A')}, {'id': ('x', 'B')},
+                                        {'id': (float('nan'), 'C')},
+                                        {'id': (2, 'D')}]))
+        assert isinstance(res[1], ValueError)
+        assert isinstance(res[2], ValueError)
+        assert [x.primary_key for x in lightmodel.get(start=0)] == ['A', 'D']
+        with pytest.raises(ValueError):
+            lightmodel.new(id=('x', 'B'))
+
+    def test_new_many_standalone(self):
+        res = list(automodel.new_many(
+            {'id': (i, str(i)), 'set': {'a', 'b'}, 'int': i} for i in range(3)))
+        assert res == list(automodel.get(start=0))
+        assert all(x.set == {'a', 'b'} for x in automodel.get(start=0))
+        assert automodel(id='2').int == 2
+
+    def test_load_auto(self):
+        values = {'set': {'1', '2'}, 'list': ['1', '2'], 'int': 12,
+                  'str': '12', 'bytes': b'12', 'hash': {'a': 'b'},
+                  'sortedset': {'a': 1.0}}
+        for i in range(3):
+            automodel.new(id=str(i), **values)
+        TEST_CONNECTION.config_resetstat()
+        lst = list(automodel.get(['0', '1', '2'], with_fields=['set', 'list']))
+        assert all(x.set == values['set'] and x.list == values['list']
+                   for x in lst)
+        stats = TEST_CONNECTION.info('commandstats')
+        assert stats['cmdstat_smembers']['calls'] == 3
+        assert stats['cmdstat_exec']['calls'] == 2
+        reloaded = automodel(id='0')
+        reloaded.load()
+        TEST_CONNECTION.config_resetstat()
+        for k, v in values.items():
+            assert getattr(reloaded, k) == v
+        assert 'cmdstat_get' not in TEST_CONNECTION.info('commandstats')
+        with pytest.raises(ValueError):
+            reloaded.load('id')
+
+    def test_large_auto(self):
+        val = [str(x) for x in range(2500)]
+        new = automodel.new(id='A', list=val)
+        assert automodel(id='A').list == val
 
     def test_auto(self):
         val = {'1', '2', '3'}
@@ -265,6 +710,32 @@ class TestModelDelete:
         assert not reloaded.good()
         assert reloaded.proxy is None
 
+    def test_delete_many(self):
+        for i in range(5):
+            fulltestmodel.new(id=str(i), unique='u' + str(i), required='',
+                              auto_set={'a'}, proxy_set={'b'})
+        # The index entry of another record is left alone
+        TEST_CONNECTION.hset(fulltestmodel.qualified(pk='3'), 'unique', 'u4')
+
+        deleted = fulltestmodel.delete_many(['0', '1', '3', 'missing'],
+                                            batch_size=2)
+        assert deleted == 3
+        assert fulltestmodel.count() == 2
+        assert sorted(TEST_CONNECTION.keys()) == [
+            b'fulltestmodel:2', b'fulltestmodel:2:auto_set',
+            b'fulltestmodel:2:proxy_set', b'fulltestmodel:4',
+            b'fulltestmodel:4:auto_set', b'fulltestmodel:4:proxy_set',
+            b'fulltestmodel:_records', b'fulltestmodel:unique']
+        assert TEST_CONNECTION.hgetall(fulltestmodel.qualified('unique')) == {
+            b'u2': b'2', b'u3': b'3', b'u4': b'4'}
+        assert fulltestmodel.delete_many([]) == 0
+
+    def test_delete_many_cache(self):
+        cachedmodel.new(id='A', str='a')
+        cachedmodel(id='A')
+        cachedmodel.delete_many(['A'])
+        assert not cachedmodel(id='A').good()
+
 
 class TestModelLoad:
 
@@ -299,6 +770,58 @@ class TestModelLoad:
         assert len(lst) == 10
         assert all(x == y for x, y in zip(instances, lst))
 
+    def test_get_by_missing_unique(self):
+        fulltestmodel.new(id='A', required='', unique='a')
+        assert not fulltestmodel(unique='b').good()
+        raw = fulltestmodel._get_raw_by_uniques('unique', ['b', 'a'])
+        assert raw[0] == {}
+        assert fulltestmodel._process_raw(raw[1])['id'] == 'A'
+
+    @pytest.mark.parametrize('prefetch', [False, True])
+    def test_get_chunked(self, prefetch):
+        instances = [fulltestmodel.new(id=(i, str(i)), required='', unique=str(i))
+                        for i in range(10)]
+        consumed = []
+        def pks():
+            for x in instances:
+                consumed.append(x)
+                yield x.primary_key
+        it = fulltestmodel.get(pks(), chunk_size=3, prefetch=prefetch)
+        assert next(it) == instances[0]
+        # Only the chunks that were requested were loaded
+        assert len(consumed) <= 6
+        assert [next(it), next(it)] == instances[1:3]
+        assert list(it) == instances[3:]
+        lst = fulltestmodel.get(unique=[str(x) for x in range(10)],
+                                chunk_size=4, prefetch=prefetch)
+        assert list(lst) == instances
+        lst = fulltestmodel.get(start=2, chunk_size=4, prefetch=prefetch)
+        assert list(lst) == instances[2:]
+        with pytest.raises(ValueError):
+            list(fulltestmodel.get([], chunk_size=0))
+
+    def test_get_rows(self):
+        foreign_a.new(id='B', b_field='C')
+        fulltestmodel.new(id='A', unique='a', required='', plain_set={1},
+                          auto_set={'x'})
+        row, = fulltestmodel.get(['A'], rows=True)
+        assert isinstance(row, tuple)
+        assert (row.id, row.unique, row.required, row.plain_set) == ('A', 'a', '', {1})
+        assert row.primary_key == 'A'
+        assert not hasattr(row, 'auto_set')
+        with pytest.raises(AttributeError):
+            row.unique = 'b'
+        with pytest.raises(AttributeError):
+            row.something = 'b'
+        instance = row.instance()
+        assert instance == fulltestmodel(id='A')
+        assert instance.auto_set == {'x'}
+        row, = foreign_a.get(start=0, rows=True)
+        assert row.b_field == 'C'
+        assert row.as_dict() == {'id': 'B', 'b_field': 'C'}
+        with pytest.raises(ValueError):
+            list(foreign_a.get(start=0, rows=True, lazy_foreign=True))
+
     def test_get_zrange(self):
         instances = []
         instances.append(lightmodel.new(id=(0, '1')))
@@ -321,6 +844,603 @@ class TestModelLoad:
         assert len(lst) == 1
         assert lst == instances[2:3]
 
+    def test_get_zrange_chunks(self):
+        instances = [lightmodel.new(id=(i, str(i))) for i in range(5)]
+        assert list(lightmodel.get(offset=1, limit=3, chunk_size=2)) == instances[1:4]
+
+        # Primary keys are read a chunk at a time
+        it = lightmodel.get(start=0, chunk_size=2)
+        assert [next(it), next(it)] == instances[:2]
+        instances.append(lightmodel.new(id=(10, '10')))
+        assert list(it) == instances[2:]
+
+        # Removed records don't shift the following chunks
+        it = lightmodel.get(start=0, stop='(10', chunk_size=2)
+        assert next(it) == instances[0]
+        instances[0].delete()
+        assert list(it) == instances[1:5]
+        assert list(lightmodel.get(start=1, stop=3, chunk_size=1)) == instances[1:4]
+
+    def test_get_deleted(self):
+        instances = [lightmodel.new(id=(i, str(i))) for i in range(4)]
+        it = lightmodel.get(pks=['0', '1', '2', '3'], chunk_size=2)
+        assert next(it) == instances[0]
+        instances[3].delete()
+        assert list(it) == instances[1:3]
+        assert list(lightmodel.get(pks=['0', 'missing', '1'])) == instances[:2]
+        assert list(lightmodel.get(pks=['missing'], rows=True)) == []
+
+
+class TestModelIterate:
+
+    def test_pages(self):
+        instances = [lightmodel.new(id=(i // 3, str(i))) for i in range(10)]
+        for reverse in (False, True):
+            expected = instances[::-1] if reverse else instances
+            pages, cursor = [], None
+            while True:
+                page, cursor = lightmodel.iterate(after=cursor, limit=4,
+                                                  reverse=reverse)
+                pages.append(page)
+                if cursor is None:
+                    break
+            assert [len(x) for x in pages] == [4, 4, 2]
+            assert sum(pages, []) == expected
+
+    def test_removed_cursor(self):
+        instances = [lightmodel.new(id=(i // 3, str(i))) for i in range(10)]
+        page, cursor = lightmodel.iterate(limit=4)
+        # The last element of the page is gone, continue after its position
+        page[-1].delete()
+        page, cursor = lightmodel.iterate(after=cursor, limit=4)
+        assert page == instances[4:8]
+        page, cursor = lightmodel.iterate(after=cursor, limit=4, reverse=True)
+        assert page == [instances[x] for x in (6, 5, 4, 2)]
+
+    def test_invalid_cursor(self):
+        with pytest.raises(ValueError):
+            lightmodel.iterate(after='?')
+
+
+class TestCache:
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        cachedmodel.cache_clear()
+        cachedmodel._cache.hits = cachedmodel._cache.misses = 0
+        cachedmodel._cache.evictions = cachedmodel._cache.expirations = 0
+
+    def test_read_through(self):
+        cachedmodel.new(id='A', str='a')
+        assert cachedmodel(id='A').str == 'a'
+        TEST_CONNECTION.config_resetstat()
+        assert cachedmodel(id='A').str == 'a'
+        assert list(cachedmodel.get(['A'])) == [cachedmodel(id='A')]
+        assert 'cmdstat_hgetall' not in TEST_CONNECTION.info('commandstats')
+        info = cachedmodel.cache_info()
+        assert (info.hits, info.misses, info.size) == (3, 1, 1)
+
+    def test_invalidation(self):
+        new = cachedmodel.new(id='A', str='a', unique='a')
+        cachedmodel(id='A')
+        new.str = 'b'
+        assert cachedmodel(id='A').str == 'b'
+        new.unique = 'b'
+        assert cachedmodel(id='A').unique == 'b'
+        del new.str
+        assert cachedmodel(id='A').str is None
+        with new:
+            new.str = 'c'
+            cachedmodel(id='A')
+        assert cachedmodel(id='A').str == 'c'
+        new.delete()
+        assert not cachedmodel(id='A').good()
+
+    def test_eviction(self, monkeypatch):
+        for x in 'ABC':
+            cachedmodel.new(id=x)
+        list(cachedmodel.instances('ABC'))
+        info = cachedmodel.cache_info()
+        assert (info.evictions, info.size) == (1, 2)
+        monkeypatch.setattr(cachedmodel._cache, 'ttl', 0)
+        cachedmodel.cache_clear()
+        cachedmodel(id='C')
+        cachedmodel(id='C')
+        assert cachedmodel.cache_info().expirations == 1
+        assert lightmodel.cache_info() is None
+
+
+class TestInvalidation:
+
+    @pytest.fixture(autouse=True)
+    def keyspace_events(self):
+        old = TEST_CONNECTION.config_get('notify-keyspace-events')
+        TEST_CONNECTION.config_set('notify-keyspace-events', 'KA')
+        yield
+        TEST_CONNECTION.config_set('notify-keyspace-events',
+                                   old['notify-keyspace-events'])
+
+    @pytest.mark.parametrize('model', [trackedmodel, keyspacemodel])
+    def test_external_writes(self, model):
+        invalidator = cache.Invalidator.for_connection(model.__redis__,
+                                                       model.cache_invalidation)
+        # Started by the first use of the cache
+        assert invalidator._thread is None
+        assert not model(id='A').good()
+        assert invalidator._thread is not None
+        wait_for(lambda: model._cache.active)
+        model.new(id='A', str='a', set={'1'})
+        assert model(id='A').str == 'a'
+        assert model(id='A').set == {'1'}
+        assert model._cache.get('A') is not None
+        assert model._cache.get(('A', 'set')) is not None
+        # Changes made by other clients
+        TEST_CONNECTION.hset(model.qualified(pk='A'), 'str', 'b')
+        wait_for(lambda: model(id='A').str == 'b')
+        TEST_CONNECTION.sadd(model.qualified('set', pk='A'), '2')
+        wait_for(lambda: model(id='A').set == {'1', '2'})
+
+    def test_listener_errors(self, monkeypatch, caplog):
+        def fail():
+            raise redis.ConnectionError
+        invalidator = cache.Invalidator(TEST_CONNECTION, 'keyspace', retry_interval=0.01)
+        monkeypatch.setattr(invalidator, '_listen', fail)
+        invalidator.register('prefix:', cache.RecordCache(1), lambda rest: None)
+        try:
+            wait_for(lambda: 'listener failed' in caplog.text)
+        finally:
+            invalidator.stop()
+
+
+@pytest.mark.skipif(aioredis is None, reason='requires redis.asyncio')
+class TestAsync:
+
+    def run(self, test, model):
+        async def main():
+            client = aioredis.Redis(port=TEST_PORT, db=TEST_DB)
+            try:
+                await test(aio.AsyncModel(model, client))
+            finally:
+                await client.aclose()
+        asyncio.run(main())
+
+    def test_new_get_delete(self):
+        async def test(am):
+            new = await am.new(id='A', unique='a', required='', auto_set={'1'})
+            with pytest.raises(exceptions.DuplicateEntry):
+                await am.new(id='B', unique='a', required='')
+            assert await am.count() == 1
+            lst = [x async for x in am.get(['A', 'missing'])]
+            assert lst == [new]
+            assert lst[0].unique == 'a'
+            lst = [x async for x in am.get(unique=['a'], with_fields=['auto_set'])]
+            assert lst[0]._field_cache['auto_set'] == {'1'}
+            lst = [x async for x in am.get(start=0, chunk_size=1)]
+            assert lst == [new]
+            await am.delete(new)
+            assert not new.good()
+            assert await am.count() == 0
+        self.run(test, fulltestmodel)
+
+    def test_update(self):
+        async def test(am):
+            new = await am.new(id='A', unique='a', required='')
+            await am.new(id='B', unique='b', required='')
+            await am.update(new, required='x', unique='c', auto_set={'1', '2'})
+            with pytest.raises(exceptions.DuplicateEntry):
+                await am.update(new, unique='b')
+            await am.proxy(new, 'proxy_set').sadd('1')
+            assert await am.proxy(new, 'proxy_set').smembers() == {b'1'}
+            await am.load(new)
+            assert new._field_cache['auto_set'] == {'1', '2'}
+            # Changes to the proxies are written
+            new.auto_set.add('3')
+            assert TEST_CONNECTION.sismember(
+                fulltestmodel.qualified('auto_set', pk='A'), '3')
+            await am.update(new, auto_set={'a'})
+            new.auto_set.add('b')
+        self.run(test, fulltestmodel)
+        # Visible to synchronous code
+        loaded = fulltestmodel(unique='c')
+        assert loaded.required == 'x'
+        assert loaded.auto_set == {'a', 'b'}
+
+    def test_attribute(self):
+        class asyncattrmodel(model.Model):
+            redis = TEST_CONNECTION
+            async_redis = aioredis.Redis(port=TEST_PORT, db=TEST_DB)
+            id = fields.PrimaryKey()
+        assert isinstance(asyncattrmodel.aio, aio.AsyncModel)
+        assert asyncattrmodel.aio.redis is asyncattrmodel.async_redis
+
+
+class TestFilter:
+
+    @staticmethod
+    def pks(it):
+        return sorted(x.primary_key for x in it)
+
+    def test_filter(self):
+        for i, (status, kind) in enumerate(['pa', 'pb', 'da', 'db', 'pa']):
+            indexedmodel.new(id=str(i), status=status, kind=kind)
+        indexedmodel.new(id='5', name='no status')
+
+        assert self.pks(indexedmodel.filter(status='p')) == ['0', '1', '4']
+        assert self.pks(indexedmodel.filter(status='p', kind='a')) == ['0', '4']
+        assert self.pks(indexedmodel.filter(status=['p', 'd'], kind='b')) == ['1', '3']
+        assert self.pks(indexedmodel.filter(status='x', kind='a')) == []
+        assert self.pks(indexedmodel.filter(status=[])) == []
+        assert self.pks(indexedmodel.filter(status='p', chunk_size=1)) == ['0', '1', '4']
+
+        with pytest.raises(ValueError):
+            indexedmodel.filter(name='no status')
+        with pytest.raises(ValueError):
+            indexedmodel.filter()
+        with pytest.raises(ValueError):
+            fields.String(unique=True, index=True)
+
+    def test_index_updates(self):
+        index = indexedmodel.qualified('_index', 'status', '')
+        new = indexedmodel.new(id='A', status='p', kind='a')
+        new.status = 'd'
+        assert self.pks(indexedmodel.filter(status='d')) == ['A']
+        assert not TEST_CONNECTION.exists(index + 'p')
+
+        with new:
+            new.status = 'x'
+            new.name = 'name'
+            assert self.pks(indexedmodel.filter(status='d')) == ['A']
+        assert self.pks(indexedmodel.filter(status='x')) == ['A']
+
+        new.autosave = False
+        new.status = 'y'
+        new.save()
+        assert self.pks(indexedmodel.filter(status='y')) == ['A']
+        assert self.pks(indexedmodel.filter(status='x')) == []
+
+        new.autosave = True
+        del new.status
+        assert self.pks(indexedmodel.filter(status='y')) == []
+        assert self.pks(indexedmodel.filter(kind='a')) == ['A']
+
+        new.delete()
+        indexedmodel.new(id='B', status='p', kind='b')
+        indexedmodel.delete_many(['B'])
+        assert not TEST_CONNECTION.keys(index[:-1] + '*')
+        assert not TEST_CONNECTION.keys(indexedmodel.qualified('_index', '*'))
+
+    def test_range(self):
+        for i, price in enumerate([30, 10, 20, 10, 40]):
+            indexedmodel.new(id=str(i), price=price)
+        indexedmodel.new(id='5', name='no price')
+
+        assert indexedmodel.range('price', pks_only=True) == ['1', '3', '2', '0', '4']
+        assert indexedmodel.range('price', 10, 20, pks_only=True) == ['1', '3', '2']
+        assert indexedmodel.range('price', '(10', 30, reverse=True,
+                                  pks_only=True) == ['0', '2']
+        assert indexedmodel.range('price', offset=1, limit=2, pks_only=True) == ['3', '2']
+        assert indexedmodel.range('price', offset=3, pks_only=True) == ['0', '4']
+        assert [x.price for x in indexedmodel.range('price', 25)] == [30, 40]
+
+        with pytest.raises(ValueError):
+            indexedmodel.range('status')
+        with pytest.raises(ValueError):
+            indexedmodel.filter(price=10)
+        with pytest.raises(ValueError):
+            indexedmodel.new(id='6', price='abc')
+        with pytest.raises(ValueError):
+            indexedmodel.new(id='6', price=float('nan'))
+
+    def test_range_invalid(self):
+        res = list(indexedmodel.new_many([{'id': 'A', 'price': float('nan')},
+                                          {'id': 'B', 'price': 10}]))
+        assert isinstance(res[0], ValueError)
+        assert res[1].price == 10
+        assert not indexedmodel(id='A').good()
+
+        # The script checks scores before writing anything
+        script_ka, _ = indexedmodel._new_arguments('C', 'abc', {
+            'id': 'C', 'name': 'c', 'price': 20})
+        with pytest.raises(redis.ResponseError):
+            indexedmodel._scripts['new'](**script_ka)
+        assert not TEST_CONNECTION.exists(indexedmodel.qualified(pk='C'))
+        assert indexedmodel.range('price', pks_only=True) == ['B']
+
+    def test_range_updates(self):
+        new = indexedmodel.new(id='A', price=10)
+        indexedmodel.new(id='B', price=20)
+        new.price = 30
+        assert indexedmodel.range('price', pks_only=True) == ['B', 'A']
+        with pytest.raises(ValueError):
+            new.price = 'abc'
+        assert indexedmodel(id='A').price == 30
+
+        del new.price
+        assert indexedmodel.range('price', pks_only=True) == ['B']
+        indexedmodel.delete_many(['B'])
+        assert not TEST_CONNECTION.exists(indexedmodel.qualified('_range', 'price'))
+
+
+class TestCluster:
+
+    def test_layout(self):
+        new = clustermodel.new(id='A', unique='a', status='p', price=10,
+                               set={'1'}, proxy={'2'})
+        assert sorted(TEST_CONNECTION.keys()) == [
+            b'clustermodel:{A}', b'clustermodel:{A}:proxy',
+            b'clustermodel:{A}:set', b'{clustermodel}:_index:status:p',
+            b'{clustermodel}:_range:price', b'{clustermodel}:_records',
+            b'{clustermodel}:unique']
+        assert clustermodel(unique='a') == new
+        assert clustermodel(id='A').set == {'1'}
+        with pytest.raises(exceptions.DuplicateEntry):
+            clustermodel.new(id='B', unique='a')
+
+    def test_hash_tags(self):
+        # The whole primary key is the hash tag
+        pk = 'a}b{%'
+        new = clustermodel.new(id=pk, set={'1'})
+        assert clustermodel.qualified('set', pk=pk) == 'clustermodel:{a%7Db%7B%25}:set'
+        assert clustermodel(id=pk).set == {'1'}
+        assert clustermodel.delete_many([pk]) == 1
+        with pytest.raises(ValueError):
+            clustermodel.new(id='')
+
+    def test_update_delete(self):
+        new = clustermodel.new(id='A', unique='a', status='p', price=10)
+        clustermodel.new(id='B', unique='b')
+        new.unique, new.status, new.price = 'c', 'd', 20
+        with pytest.raises(exceptions.DuplicateEntry):
+            new.unique = 'b'
+        assert clustermodel(unique='c').status == 'd'
+        assert not clustermodel(unique='a').good()
+        assert [x.primary_key for x in clustermodel.filter(status='d')] == ['A']
+        assert clustermodel.range('price', 15, pks_only=True) == ['A']
+
+        del new.status
+        assert list(clustermodel.filter(status='d')) == []
+        new.delete()
+        assert not clustermodel(id='A').good()
+        assert clustermodel.range('price', pks_only=True) == []
+        assert TEST_CONNECTION.hgetall(clustermodel.qualified('unique')) == {
+            b'b': b'B'}
+
+    def test_many(self):
+        res = list(clustermodel.new_many([{'id': 'A', 'unique': 'a'},
+                                          {'id': 'B', 'unique': 'a'},
+                                          {'id': 'C', 'set': {'1'}}]))
+        assert isinstance(res[1], exceptions.DuplicateEntry)
+        assert [x.primary_key for x in clustermodel.get(pks=['A', 'C'])] == ['A', 'C']
+        assert clustermodel(id='C').set == {'1'}
+        assert clustermodel.delete_many(['A', 'C', 'missing']) == 2
+        assert TEST_CONNECTION.keys() == []
+
+    def test_save(self):
+        new = clustermodel.new(id='A', unique='a')
+        new.autosave = False
+        new.unique, new.status = 'b', 'p'
+        new.save()
+        assert clustermodel(unique='b').status == 'p'
+        assert [x.primary_key for x in clustermodel.filter(status='p')] == ['A']
+
+    def test_migrate(self):
+        target = TEST_SHARD
+
+        def define(connection, layout):
+            class migrated(model.Model):
+                redis = connection
+                cluster_layout = layout
+                id = fields.PrimaryKey()
+                unique = fields.String(unique=True)
+                status = fields.String(index=True)
+                set = fields.Set(auto=True)
+            return migrated
+
+        old = define(TEST_CONNECTION, False)
+        for i in range(5):
+            old.new(id=str(i), unique='u' + str(i), status='s', set={str(i)})
+        new = define(target, True)
+        assert cluster.migrate(new, TEST_CONNECTION, batch_size=2) == 5
+        assert new.count() == 5
+        assert new(unique='u3').set == {'3'}
+        assert len(list(new.filter(status='s'))) == 5
+
+        with pytest.raises(ValueError):
+            cluster.migrate(old, TEST_CONNECTION)
+
+    def test_redis_cluster(self):
+        # Requires a Redis Cluster with a node at 127.0.0.1:7000
+        rc = pytest.importorskip('redis.cluster')
+        try:
+            client = rc.RedisCluster(host='127.0.0.1', port=7000)
+        except (redis.exceptions.RedisError, redis.exceptions.RedisClusterException):
+            pytest.skip('requires Redis Cluster')
+
+        class clustered(model.Model):
+            redis = client
+            cluster_layout = True
+            id = fields.PrimaryKey()
+            unique = fields.String(unique=True)
+            status = fields.String(index=True)
+            list = fields.List(auto=True)
+
+        try:
+            pks = [str(i) for i in range(50)]
+            res = clustered.new_many({'id': x, 'unique': 'u' + x, 'status': 's',
+                                      'list': [x]} for x in pks)
+            assert all(isinstance(x, clustered) for x in res)
+            assert [x.unique for x in clustered.get(pks=pks)] == ['u' + x for x in pks]
+            ob = clustered(unique='u7')
+            ob.list.append('8')
+            with ob:
+                ob.unique, ob.status = 'a', 't'
+            assert clustered(unique='a').list == ['7', '8']
+            assert [x.primary_key for x in clustered.filter(status='t')] == ['7']
+            ob.list = ['3', '1', '2']
+            ob.list.sort()
+            ob.list.insert(0, '0')
+            assert clustered(id='7').list == ['0', '1', '2', '3']
+            ob.autosave = False
+            ob.status, ob.list = 'u', ['9']
+            ob.save()
+            assert clustered(id='7').list == ['9']
+            assert [x.primary_key for x in clustered.filter(status='u')] == ['7']
+            assert list(clustered.filter(status='t')) == []
+            ob.delete()
+            assert clustered.delete_many(pks) == 49
+            assert clustered.count() == 0
+        finally:
+            for node in client.get_primaries():
+                client.get_redis_connection(node).flushdb()
+
+        with pytest.raises(exceptions.FusedError):
+            class notclustered(model.Model):
+                redis = client
+                id = fields.PrimaryKey()
+
+
+class TestShards:
+
+    def test_ring(self):
+        shards = shard.ShardMap({'a': 'A', 'b': 'B'})
+        pks = [str(i) for i in range(1000)]
+        before = [shards.get(x) for x in pks]
+        assert 300 < before.count('A') < 700
+        # Only the records of the new shard move
+        shards = shard.ShardMap({'a': 'A', 'b': 'B', 'c': 'C'})
+        after = [shards.get(x) for x in pks]
+        assert all(x == y for x, y in zip(before, after) if y != 'C')
+        assert sorted(shards.group(pks[:10])) == sorted(set(after[:10]))
+
+    def test_routing(self):
+        pks = [str(i) for i in range(20)]
+        for i, pk in enumerate(pks):
+            shardedmodel.new(id=pk, status='even' if i % 2 else 'odd',
+                             price=i, list=[pk])
+        assert shardedmodel.count() == 20
+        assert 0 < TEST_CONNECTION.zcard(shardedmodel.qualified('_records')) < 20
+
+        ob = shardedmodel(id='7')
+        ob.list.append('x')
+        ob.proxy.sadd('y')
+        ob.status = 'odd'
+        reloaded = shardedmodel(id='7')
+        assert reloaded.list == ['7', 'x']
+        assert reloaded.proxy.smembers() == {b'y'}
+        assert ob.redis is shardedmodel.redis.get('7')
+        assert ob.redis.exists(shardedmodel.qualified(pk='7'))
+
+        loaded = list(shardedmodel.get(pks=pks[::-1], with_fields=['list']))
+        assert [x.primary_key for x in loaded] == pks[::-1]
+        assert loaded[0]._field_cache['list'] == ['19']
+        assert len(list(shardedmodel.filter(status='odd'))) == 11
+
+    def test_aggregation(self):
+        for i in range(20):
+            shardedmodel.new(id=(i, 'r' + str(i)), price=i)
+        assert shardedmodel.range('price', 5, 15, offset=2, limit=3,
+                                  pks_only=True) == ['r7', 'r8', 'r9']
+        assert shardedmodel.range('price', '(15', reverse=True,
+                                  pks_only=True) == ['r19', 'r18', 'r17', 'r16']
+        assert [x.primary_key for x in shardedmodel.get(start=3, offset=1, limit=2)] == ['r4', 'r5']
+        assert [x.primary_key for x in shardedmodel.get(
+            start=3, stop=12, offset=1, limit=7, chunk_size=3)] == [
+                'r' + str(i) for i in range(4, 11)]
+
+        seen, after = [], None
+        while True:
+            page, after = shardedmodel.iterate(after, limit=6, reverse=True)
+            seen.extend(x.primary_key for x in page)
+            if after is None:
+                break
+        assert seen == ['r' + str(i) for i in range(19, -1, -1)]
+
+        shardedmodel(id='r3').delete()
+        assert shardedmodel.delete_many(['r' + str(i) for i in range(10)]) == 9
+        assert shardedmodel.count() == 10
+        assert shardedmodel.range('price', 0, 9, pks_only=True) == []
+
+    def test_unsupported(self):
+        with pytest.raises(exceptions.UnsupportedOperation):
+            class shardedunique(model.Model):
+                redis = shard.ShardMap([TEST_CONNECTION, TEST_SHARD])
+                id = fields.PrimaryKey()
+                unique = fields.String(unique=True)
+        with pytest.raises(exceptions.UnsupportedOperation):
+            shardedmodel.get_pipeline()
+
+
+class TestReplicas:
+
+    def test_reads(self):
+        new = replicatedmodel.new(id='A', unique='a', status='s', list=['1'])
+        assert not replicatedmodel(id='A').good()
+        assert not replicatedmodel(unique='a').good()
+        assert replicatedmodel.count() == 0
+        assert list(replicatedmodel.filter(status='s')) == []
+        assert new.list == []
+        new.load(consistent=True)
+        assert new.list == ['1']
+
+        assert replicatedmodel(id='A', consistent=True) == new
+        assert replicatedmodel(unique='a', consistent=True) == new
+        assert replicatedmodel.count(consistent=True) == 1
+        assert list(replicatedmodel.filter(status='s', consistent=True)) == [new]
+        assert list(replicatedmodel.get(start=0, consistent=True)) == [new]
+        with replica.consistent():
+            loaded = list(replicatedmodel.get(pks=['A', 'A'], chunk_size=1,
+                                              prefetch=True))
+            assert loaded == [new, new]
+            assert replicatedmodel(id='A').list == ['1']
+        assert not replicatedmodel(id='A').good()
+
+    def test_thread_local(self, monkeypatch):
+        # Python < 3.7, without contextvars
+        monkeypatch.setattr(replica, '_consistent',
+                            replica._LocalVar('consistent', default=False))
+        new = replicatedmodel.new(id='A')
+        with replica.consistent():
+            assert replica.is_consistent()
+            loaded = list(replicatedmodel.get(pks=['A', 'A'], chunk_size=1,
+                                              prefetch=True))
+            assert loaded == [new, new]
+        assert not replica.is_consistent()
+        assert not replicatedmodel(id='A').good()
+
+    def test_balancing(self):
+        class unreachable:
+            def ping(self):
+                raise redis.ConnectionError
+        dead = unreachable()
+        replicas = replica.ReplicaSet([TEST_CONNECTION, dead])
+        assert [replicas.get() for _ in range(3)] == [TEST_CONNECTION, dead,
+                                                      TEST_CONNECTION]
+        replicas = replica.ReplicaSet([dead, TEST_CONNECTION], 'latency')
+        assert replicas.get() is TEST_CONNECTION
+        assert replicas.latency()[0] == float('inf')
+
+        # Later measurements run in the background
+        replicas = replica.ReplicaSet([TEST_CONNECTION], 'latency', probe_interval=0)
+        assert replicas.get() is TEST_CONNECTION
+        replicas.connections[0] = dead
+        replicas.get()
+        for _ in range(100):
+            if replicas.latency()[0] == float('inf'):
+                break
+            time.sleep(0.01)
+        assert replicas.get() is None
+
+        # Without reachable replicas models read from the primary
+        class fallbackmodel(model.Model):
+            redis = TEST_CONNECTION
+            redis_read = [dead]
+            read_balancing = 'latency'
+            id = fields.PrimaryKey()
+        new = fallbackmodel.new(id='A')
+        assert fallbackmodel(id='A') == new
+        with pytest.raises(ValueError):
+            replica.ReplicaSet([TEST_CONNECTION], 'random')
+
 
 class TestModelMisc:
 
@@ -336,6 +1456,19 @@ class TestModelMisc:
         assert f != r1
         assert hash(f) != hash(r1)
 
+    def test_instances(self):
+        instances = [lightmodel.new(id=str(i)) for i in range(10)]
+        mixed = [instances[0], {'id': '1'}] + [str(i) for i in range(2, 10)]
+        mixed.append('missing')
+        TEST_CONNECTION.config_resetstat()
+        res = list(lightmodel.instances(mixed, chunk_size=3))
+        assert res[0] is instances[0]
+        assert res[:10] == instances
+        assert not res[10].good()
+        # The missing record isn't requested again
+        stats = TEST_CONNECTION.info('commandstats')
+        assert stats['cmdstat_hgetall']['calls'] == 9
+
     def test_count(self):
         assert lightmodel.count() == 0
         new = lightmodel.new(id='A')
@@ -388,6 +1521,123 @@ class TestForeign:
         assert ls1.field.field.field.field is ls1
 
 
+    def test_prefetch_related(self):
+        for i in range(5):
+            foreign_a.new(id=(i, 'A' + str(i)), b_field='B' + str(i))
+            foreign_b.new(id=(i, 'B' + str(i)), a_field='A' + str(i))
+        TEST_CONNECTION.config_resetstat()
+        lst = list(foreign_a.get(start=0, prefetch_related=['b_field']))
+        stats = TEST_CONNECTION.info('commandstats')
+        # No requests were made for individual instances
+        assert stats['cmdstat_hgetall']['calls'] == 10
+        assert stats['cmdstat_exec']['calls'] == 2
+        assert [x.primary_key for x in lst] == ['A' + str(i) for i in range(5)]
+        for x in lst:
+            assert x.b_field.primary_key == 'B' + x.primary_key[1:]
+            assert x.b_field.a_field is x
+
+    def test_prefetch_related_depth(self):
+        for x, y in zip('ABC', 'BCD'):
+            self_foreign.new(id=x, field=y)
+        self_foreign.new(id='D')
+        lst = list(self_foreign.get(['A'], prefetch_related=['field'],
+                                    prefetch_depth=3))
+        assert lst[0].field.primary_key == 'B'
+        assert lst[0].field.field.primary_key == 'C'
+        assert lst[0].field.field.field.primary_key == 'D'
+        with pytest.raises(ValueError):
+            list(self_foreign.get(['A'], prefetch_related=['id']))
+
+
+    def test_lazy_field(self):
+        light = lightmodel.new(id='A')
+        lazymodel.new(id='X', field='A')
+        TEST_CONNECTION.config_resetstat()
+        loaded = lazymodel(id='X')
+        assert isinstance(loaded.field, lightmodel)
+        assert isinstance(loaded.field, proxies.foreignproxy)
+        assert loaded.field.primary_key == 'A'
+        assert loaded.field == light and light == loaded.field
+        assert hash(loaded.field) == hash(light)
+        stats = TEST_CONNECTION.info('commandstats')
+        assert stats['cmdstat_hgetall']['calls'] == 1
+        assert not loaded.field.loaded()
+        assert loaded.field.good()
+        assert loaded.field.loaded()
+        stats = TEST_CONNECTION.info('commandstats')
+        assert stats['cmdstat_hgetall']['calls'] == 2
+
+    def test_lazy_query(self):
+        foreign_a.new(id='A', b_field='B')
+        foreign_b.new(id='B', a_field='A')
+        TEST_CONNECTION.config_resetstat()
+        la, = foreign_a.get(['A'], lazy_foreign=True)
+        stats = TEST_CONNECTION.info('commandstats')
+        assert stats['cmdstat_hgetall']['calls'] == 1
+        assert la.b_field.primary_key == 'B'
+        assert la.b_field.a_field is la
+
+
+class TestCodec:
+
+    values = {'list': [1, 'a', b'b', (2, 3), None, [1.5]],
+              'set': {1, 'a', b'b', ('c',), frozenset({1})},
+              'hash': {'a': 'b', 1: 2, ('t',): {'\x00s': 1}},
+              'sortedset': {'a': 1.0, 'b': 2.5},
+              'literal': [1, 'a']}
+
+    def test_roundtrip(self):
+        containermodel.new(id='A', **self.values)
+        loaded = containermodel(id='A')
+        for k, v in self.values.items():
+            assert getattr(loaded, k) == v
+        raw = TEST_CONNECTION.hgetall(containermodel.qualified(pk='A'))
+        assert raw[b'list'].startswith(b'J')
+        assert raw[b'literal'] == b"[1, 'a']"
+
+    def test_legacy(self):
+        values = dict(self.values, set={1, 'a', b'b', ('c',)})
+        containermodel.new(id='A')
+        TEST_CONNECTION.hmset(containermodel.qualified(pk='A'),
+                              {k: str(v) for k, v in values.items()})
+        loaded = containermodel(id='A')
+        for k, v in values.items():
+            assert getattr(loaded, k) == v
+        # Rewritten with the current codec
+        loaded.set = loaded.set
+        raw = TEST_CONNECTION.hget(containermodel.qualified(pk='A'), 'set')
+        assert raw.startswith(b'J')
+        assert containermodel(id='A').set == values['set']
+
+    def test_model_codec(self):
+        literalmodel.new(id='A', list=[1, 2])
+        raw = TEST_CONNECTION.hget(literalmodel.qualified(pk='A'), 'list')
+        assert raw == b'[1, 2]'
+        assert literalmodel(id='A').list == [1, 2]
+
+    def test_inherited_codec(self):
+        class base(model.Model):
+            redis = TEST_CONNECTION
+            id = fields.PrimaryKey()
+            list = fields.List()
+
+        class literal(base):
+            codec = codec.Literal()
+
+        class default(base):
+            pass
+
+        literal.new(id='A', list=[1, 2])
+        default.new(id='A', list=[1, 2])
+        assert TEST_CONNECTION.hget(literal.qualified(pk='A'), 'list') == b'[1, 2]'
+        assert TEST_CONNECTION.hget(default.qualified(pk='A'), 'list').startswith(b'J')
+        assert base._fields['list'].codec is None
+
+    def test_unsupported(self):
+        with pytest.raises(TypeError):
+            containermodel.new(id='A', list=[object()])
+
+
 class TestEncoding:
 
     # TODO: standalone
@@ -417,3 +1667,10 @@ class TestEncoding:
         # decode_responses is False, 'bytes' won't be decoded
         for k in ka.keys():
             assert ka[k] == getattr(reloaded, k)
+
+    def test_process_raw(self):
+        expected = {'id': 'A', 'str': 'é', 'plain_set': {1}}
+        raw = {'id': 'A', 'str': 'é', 'plain_set': 'J{"\\u0000s":[1]}'}
+        assert decodetestmodel._process_raw(raw) == expected
+        raw = {k.encode(): v.encode() for k, v in raw.items()}
+        assert nodecodetestmodel._process_raw(raw) == expected